@@ -0,0 +1,116 @@
+# backplane.py
+#
+# Pub/sub transport between uvicorn workers for SSE events. The broker in
+# sse.py publishes every event to the backplane and only delivers what
+# comes back out of it, so all workers see the same stream.
+#
+#   SSE_BACKPLANE=memory   single process (default)
+#   SSE_BACKPLANE=redis    any Redis-compatible server at REDIS_URL
+#
+# The backplane also numbers events, so ids are the same on every worker.
+
+import asyncio
+import json
+import os
+import time
+
+SSE_BACKPLANE = os.getenv("SSE_BACKPLANE", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_CHANNEL = os.getenv("SSE_REDIS_CHANNEL", "whats_server:sse")
+REDIS_EVENT_ID_KEY = os.getenv("SSE_REDIS_EVENT_ID_KEY", "whats_server:sse:last_id")
+
+# Numbering and publishing in one script keeps ids in channel order across workers
+PUBLISH_SCRIPT = """
+local id = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', ARGV[1], id .. '|' .. ARGV[2])
+return id
+"""
+
+
+class InMemoryBackplane:
+    def __init__(self):
+        self.deliver = None
+        # Seeded from the clock so ids keep growing across restarts
+        self.last_event_id = int(time.time() * 1000)
+
+    def attach(self, deliver):
+        self.deliver = deliver
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def publish(self, data, chat_id=None):
+        self.last_event_id += 1
+        self.deliver(data, chat_id, self.last_event_id)
+
+
+class RedisBackplane:
+    def __init__(self, url=REDIS_URL, channel=REDIS_CHANNEL, event_id_key=REDIS_EVENT_ID_KEY):
+        self.url = url
+        self.channel = channel
+        self.event_id_key = event_id_key
+        self.deliver = None
+        self.redis = None
+        # Single sender keeps events in publish order
+        self.outbound = asyncio.Queue()
+        self.tasks = []
+
+    def attach(self, deliver):
+        self.deliver = deliver
+
+    async def start(self):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(self.url)
+        self.tasks = [
+            asyncio.create_task(self.listen()),
+            asyncio.create_task(self.send())
+        ]
+        print(f"📡 SSE backplane connected to {self.url} ({self.channel})")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.redis:
+            await self.redis.aclose()
+
+    def publish(self, data, chat_id=None):
+        self.outbound.put_nowait(json.dumps({"chatId": chat_id, "data": data}))
+
+    async def send(self):
+        while True:
+            envelope = await self.outbound.get()
+            while True:
+                try:
+                    await self.redis.eval(PUBLISH_SCRIPT, 1, self.event_id_key, self.channel, envelope)
+                    break
+                except Exception as e:
+                    print(f"⚠️ SSE backplane publish failed, retrying: {e}")
+                    await asyncio.sleep(1)
+
+    async def listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    event_id, _, raw = message["data"].partition(b"|")
+                    envelope = json.loads(raw)
+                    self.deliver(envelope["data"], envelope["chatId"], int(event_id))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ SSE backplane subscription lost, reconnecting: {e}")
+                await asyncio.sleep(1)
+
+
+def create_backplane():
+    if SSE_BACKPLANE == "redis":
+        return RedisBackplane()
+    return InMemoryBackplane()
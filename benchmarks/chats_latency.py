@@ -0,0 +1,91 @@
+# chats_latency.py
+#
+# Measures /api/chats latency while a burst of webhooks is being processed.
+# Run it against a live server:
+#
+#   python benchmarks/chats_latency.py --base-url http://localhost:5000 --webhooks 500
+#
+# Note: the webhooks are real, so point it at a dev database.
+
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+
+def fake_webhook(from_number):
+    return {
+        "entry": [{
+            "changes": [{
+                "value": {
+                    "metadata": {"phone_number_id": "bench"},
+                    "messages": [{
+                        "id": f"wamid.{uuid.uuid4().hex}",
+                        "from": from_number,
+                        "type": "text",
+                        "text": {"body": "benchmark message"}
+                    }]
+                }
+            }]
+        }]
+    }
+
+
+async def fire_webhooks(client, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            await client.post("/webhook", json=fake_webhook(f"34600{i % 50:06d}"))
+
+    await asyncio.gather(*(one(i) for i in range(total)))
+
+
+async def poll_chats(client, stop_event, samples):
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        response = await client.get("/api/chats")
+        samples.append((time.perf_counter() - start) * 1000)
+        response.raise_for_status()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://localhost:5000")
+    parser.add_argument("--webhooks", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args()
+
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=30) as client:
+        samples = []
+        stop_event = asyncio.Event()
+        readers = [asyncio.create_task(poll_chats(client, stop_event, samples)) for _ in range(args.readers)]
+
+        start = time.perf_counter()
+        await fire_webhooks(client, args.webhooks, args.concurrency)
+        elapsed = time.perf_counter() - start
+
+        stop_event.set()
+        await asyncio.gather(*readers)
+
+    print(f"webhooks: {args.webhooks} in {elapsed:.2f}s ({args.webhooks / elapsed:.1f}/s)")
+    print(f"/api/chats samples: {len(samples)}")
+    if samples:
+        print(f"  p50: {statistics.median(samples):.1f} ms")
+        print(f"  p95: {percentile(samples, 95):.1f} ms")
+        print(f"  p99: {percentile(samples, 99):.1f} ms")
+        print(f"  max: {max(samples):.1f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+# graph_client_stub.py
+#
+# Runs graph_api.GraphClient against an in-process stub of the Graph API
+# (httpx.MockTransport, no network or server) to check retry, Retry-After
+# and rate-limit behaviour without touching Meta:
+#
+#   python benchmarks/graph_client_stub.py --rate 20 --requests 60
+#
+# The stub answers 429 (with Retry-After) and 503 for the first calls of
+# each message id, then 200. It also checks that a huge Retry-After is
+# capped at backoff_max and that a retried multipart upload resends the
+# whole file.
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graph_api import GraphClient  # noqa: E402
+
+calls = Counter()
+arrivals = []
+upload_bodies = []
+
+
+def stub(request):
+    if request.url.path.endswith("/media"):
+        upload_bodies.append(request.read())
+        if len(upload_bodies) == 1:
+            return httpx.Response(503, json={"error": "unavailable"})
+        return httpx.Response(200, json={"id": "media.1"})
+
+    key = json.loads(request.content)["key"]
+    calls[key] += 1
+    arrivals.append(time.monotonic())
+
+    if key == "slow" and calls[key] == 1:
+        # An hour: the client must not actually wait this long
+        return httpx.Response(429, json={"error": "throttled"}, headers={"Retry-After": "3600"})
+    if calls[key] == 1:
+        return httpx.Response(429, json={"error": "throttled"}, headers={"Retry-After": "0.2"})
+    if calls[key] == 2:
+        return httpx.Response(503, json={"error": "unavailable"})
+    return httpx.Response(200, json={"messages": [{"id": f"wamid.{key}"}]})
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=20)
+    parser.add_argument("--requests", type=int, default=60)
+    args = parser.parse_args()
+
+    client = GraphClient(
+        base_url="http://graph.test/v19.0",
+        rate=args.rate,
+        backoff_base=0.05,
+        backoff_max=0.5,
+        transport=httpx.MockTransport(stub)
+    )
+    try:
+        start = time.monotonic()
+        responses = await asyncio.gather(*(client.post("/messages", json={"key": i}) for i in range(args.requests)))
+        elapsed = time.monotonic() - start
+
+        slow_start = time.monotonic()
+        slow = await client.post("/messages", json={"key": "slow"})
+        slow_elapsed = time.monotonic() - slow_start
+
+        with tempfile.NamedTemporaryFile(suffix=".bin") as f:
+            payload = os.urandom(256 * 1024)
+            f.write(payload)
+            f.flush()
+            with open(f.name, "rb") as upload:
+                uploaded = await client.post("/123/media", files={"file": ("a.bin", upload, "application/octet-stream")})
+    finally:
+        await client.close()
+
+    ok = sum(1 for r in responses if r.status_code == 200)
+    total_calls = sum(calls[i] for i in range(args.requests))
+    # Busiest one-second window seen by the stub
+    peak = max(sum(1 for t in arrivals if s <= t < s + 1) for s in arrivals)
+
+    print(f"requests: {args.requests}  succeeded: {ok}  upstream calls: {total_calls}  elapsed: {elapsed:.2f}s")
+    print(f"client stats: {client.stats}")
+    print(f"peak calls in any 1s window: {peak} (limit {args.rate:.0f} + burst)")
+    print(f"Retry-After: 3600 handled in {slow_elapsed:.2f}s")
+
+    assert ok == args.requests, "every request should succeed after retries"
+    assert total_calls == args.requests * 3, "each request should take exactly two retries"
+    assert peak <= 2 * args.rate, "token bucket should cap throughput"
+    assert slow.status_code == 200 and slow_elapsed < 2, "Retry-After should be capped at backoff_max"
+    assert uploaded.status_code == 200 and len(upload_bodies) == 2, "upload should be retried once"
+    assert all(payload in body for body in upload_bodies), "a retried upload must resend the whole file"
+    print("✅ Retry, Retry-After cap, upload rewind and rate limiting behave as expected")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
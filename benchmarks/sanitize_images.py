@@ -0,0 +1,88 @@
+# sanitize_images.py
+#
+# Micro-benchmark for functions.sanitize_image on typical phone photo
+# sizes, compared with the old full-resolution decode + re-encode.
+#
+#   python benchmarks/sanitize_images.py --repeat 5
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from functions import sanitize_image, IMAGE_MAX_EDGE  # noqa: E402
+
+# name -> (width, height)
+PHONE_SIZES = {
+    "8MP": (3264, 2448),
+    "12MP": (4032, 3024),
+    "48MP": (8000, 6000),
+}
+
+
+def make_photo(path, size, exif=True):
+    # Noise upscaled to full size: compresses roughly like a real photo
+    small = Image.merge("RGB", [Image.effect_noise((size[0] // 8, size[1] // 8), 64) for _ in range(3)])
+    img = small.resize(size, Image.BILINEAR)
+    kwargs = {"quality": 92}
+    if exif:
+        exif_data = Image.Exif()
+        exif_data[0x0112] = 1  # Orientation
+        kwargs["exif"] = exif_data.tobytes()
+    img.save(path, format="JPEG", **kwargs)
+
+
+def sanitize_full_resolution(input_path, output_path):
+    # What sanitize_image did before: decode everything, re-encode everything
+    with Image.open(input_path) as img:
+        img.convert("RGB").save(output_path, format="JPEG", quality=85)
+
+
+def time_run(func, source, workdir, repeat):
+    samples = []
+    for i in range(repeat):
+        input_path = os.path.join(workdir, f"in_{i}.jpg")
+        output_path = os.path.join(workdir, f"out_{i}.jpg")
+        shutil.copyfile(source, input_path)
+        start = time.perf_counter()
+        func(input_path, output_path)
+        samples.append((time.perf_counter() - start) * 1000)
+        for path in (input_path, output_path):
+            if os.path.exists(path):
+                os.remove(path)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"IMAGE_MAX_EDGE={IMAGE_MAX_EDGE}")
+    print(f"{'size':>6} {'full decode':>12} {'sanitize':>10} {'speedup':>8}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, size in PHONE_SIZES.items():
+            source = os.path.join(workdir, f"{name}.jpg")
+            make_photo(source, size)
+
+            before = time_run(sanitize_full_resolution, source, workdir, args.repeat)
+            after = time_run(sanitize_image, source, workdir, args.repeat)
+            print(f"{name:>6} {before:>10.1f}ms {after:>8.1f}ms {before / after:>7.1f}x")
+
+        # A small clean JPEG should skip re-encoding entirely
+        clean = os.path.join(workdir, "clean.jpg")
+        make_photo(clean, (1600, 1200), exif=False)
+        passthrough = time_run(sanitize_image, clean, workdir, args.repeat)
+        print(f"{'clean':>6} {'-':>12} {passthrough:>8.1f}ms  (passthrough)")
+
+
+if __name__ == "__main__":
+    main()
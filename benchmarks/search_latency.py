@@ -0,0 +1,142 @@
+# search_latency.py
+#
+# Query latency of search.search_messages on a synthetic corpus, run
+# directly against MongoDB (same pipeline and index as /api/search).
+# Seeds a separate database so the real one is never touched:
+#
+#   python benchmarks/search_latency.py --messages 1000000 --queries 200
+#   python benchmarks/search_latency.py --skip-seed          # reuse the corpus
+#
+# Vocabulary frequencies are Zipf-like, so there are common terms (huge
+# match sets), mid-frequency terms and rare ones.
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import client  # noqa: E402
+from indexes import INDEXES  # noqa: E402
+from search import search_messages, SEARCH_PAGE_SIZE  # noqa: E402
+
+VOCABULARY_SIZE = 20000
+WORDS_PER_MESSAGE = (3, 25)
+CHATS = 5000
+BATCH_SIZE = 10000
+
+
+def make_vocabulary(rng):
+    syllables = ["ba", "ce", "di", "fo", "gu", "la", "me", "ni", "po", "ru", "sa", "te", "vi", "zo", "qui", "tra"]
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def pick_word(rng, vocabulary):
+    # Zipf-ish: low ranks are far more common
+    return vocabulary[min(len(vocabulary) - 1, int(rng.paretovariate(1.1)) - 1)]
+
+
+async def seed(collection, total, rng, vocabulary):
+    await collection.drop()
+    start_time = datetime.utcnow() - timedelta(days=365)
+    started = time.perf_counter()
+
+    for offset in range(0, total, BATCH_SIZE):
+        batch = []
+        for i in range(offset, min(total, offset + BATCH_SIZE)):
+            words = [pick_word(rng, vocabulary) for _ in range(rng.randint(*WORDS_PER_MESSAGE))]
+            doc = {
+                "_id": f"m{i:08d}",
+                "chatWaId": f"34600{rng.randrange(CHATS):06d}",
+                "sender": "them" if rng.random() < 0.5 else "me",
+                "content": " ".join(words).capitalize(),
+                "timestamp": start_time + timedelta(seconds=i * 30),
+                "status": "read",
+                "file": None,
+                "fileName": None
+            }
+            if rng.random() < 0.05:
+                doc["fileName"] = f"{pick_word(rng, vocabulary)}_{i}.pdf"
+            batch.append(doc)
+        await collection.insert_many(batch, ordered=False)
+        print(f"\r   seeded {offset + len(batch):>9}/{total}", end="", flush=True)
+    print(f"\n   seeding took {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    for name, keys, options in INDEXES["messages"]:
+        await collection.create_index(keys, name=name, **options)
+    print(f"   indexing took {time.perf_counter() - started:.1f}s")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def measure(collection, label, queries, pages):
+    samples = []
+    hits = 0
+    for q, chat_id in queries:
+        cursor = None
+        for _ in range(pages):
+            start = time.perf_counter()
+            page, next_key = await search_messages(collection, q, chat_id=chat_id, cursor=cursor)
+            samples.append((time.perf_counter() - start) * 1000)
+            hits += len(page)
+            if not next_key:
+                break
+            cursor = next_key
+    print(
+        f"{label:<22} n={len(samples):>4}  p50={statistics.median(samples):>8.1f}ms  "
+        f"p95={percentile(samples, 95):>8.1f}ms  p99={percentile(samples, 99):>8.1f}ms  "
+        f"avg hits/page={hits / len(samples):.1f}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--pages", type=int, default=3, help="pages to walk per query")
+    parser.add_argument("--database", default="whatsapp_search_bench")
+    parser.add_argument("--skip-seed", action="store_true")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng)
+    collection = client[args.database]["messages"]
+
+    if not args.skip_seed:
+        print(f"🌱 Seeding {args.messages} messages into {args.database}.messages")
+        await seed(collection, args.messages, rng, vocabulary)
+
+    count = await collection.estimated_document_count()
+    print(f"📚 Corpus: {count} messages, page size {SEARCH_PAGE_SIZE}")
+
+    def chat():
+        return f"34600{rng.randrange(CHATS):06d}"
+
+    common = vocabulary[:20]
+    mid = vocabulary[100:1000]
+    rare = vocabulary[5000:]
+    n = args.queries
+    await measure(collection, "common term", [(rng.choice(common), None) for _ in range(n)], args.pages)
+    await measure(collection, "mid-frequency term", [(rng.choice(mid), None) for _ in range(n)], args.pages)
+    await measure(collection, "rare term", [(rng.choice(rare), None) for _ in range(n)], args.pages)
+    await measure(collection, "two terms", [(f"{rng.choice(mid)} {rng.choice(mid)}", None) for _ in range(n)], args.pages)
+    await measure(collection, "phrase", [(f'"{rng.choice(common)} {rng.choice(common)}"', None) for _ in range(n)], args.pages)
+    await measure(collection, "common term, one chat", [(rng.choice(common), chat()) for _ in range(n)], args.pages)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,169 @@
+# sse_backplane_check.py
+#
+# Cross-process check for sse.Broker: several worker processes, each with
+# its own Broker, publish events and must all deliver every event with
+# the same ids in the same order. Chat filtering and Last-Event-ID replay
+# are checked on every worker too.
+#
+#   python benchmarks/sse_backplane_check.py                  # no services needed
+#   python benchmarks/sse_backplane_check.py --redis redis://localhost:6379/0
+#
+# Without --redis the workers talk through a sequencer process that does
+# what the Redis script does (number, then fan out), so only the broker
+# side is exercised. With --redis the real RedisBackplane is used.
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Room for every event, so drops can't hide delivery bugs
+os.environ.setdefault("SSE_QUEUE_SIZE", "100000")
+os.environ.setdefault("SSE_REPLAY_SIZE", "100000")
+
+from sse import Broker  # noqa: E402
+
+
+class PipeBackplane:
+    # Same contract as RedisBackplane: publish goes out, numbered events come back
+    def __init__(self, outbound, inbound):
+        self.outbound = outbound
+        self.inbound = inbound
+        self.deliver = None
+        self.task = None
+
+    def attach(self, deliver):
+        self.deliver = deliver
+
+    async def start(self):
+        self.task = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        # Wake the blocked get() so its thread can finish
+        self.inbound.put(None)
+        await self.task
+
+    def publish(self, data, chat_id=None):
+        self.outbound.put((data, chat_id))
+
+    async def listen(self):
+        while True:
+            message = await asyncio.to_thread(self.inbound.get)
+            if message is None:
+                return
+            event_id, data, chat_id = message
+            self.deliver(data, chat_id, event_id)
+
+
+def sequencer(inbound, outbounds, total):
+    # Stand-in for Redis INCR + PUBLISH
+    for event_id in range(1, total + 1):
+        data, chat_id = inbound.get()
+        for queue in outbounds:
+            queue.put((event_id, data, chat_id))
+
+
+async def run_worker(index, workers, events, backplane, ready, results):
+    broker = Broker(backplane)
+    everything = broker.subscribe()
+    only_a = broker.subscribe(["chat-a"])
+    await backplane.start()
+    # Redis SUBSCRIBE is asynchronous; give every worker time to be listening
+    await asyncio.sleep(0.5)
+    await asyncio.to_thread(ready.wait)
+
+    for i in range(events):
+        broker.publish({"worker": index, "seq": i}, chat_id="chat-a" if i % 2 == 0 else "chat-b")
+
+    total = workers * events
+    received = []
+    while len(received) < total:
+        frame = await asyncio.wait_for(everything.queue.get(), timeout=30)
+        received.append(frame)
+
+    filtered = []
+    while not only_a.queue.empty():
+        filtered.append(only_a.queue.get_nowait())
+
+    # A client that saw the first half reconnects and must get exactly the rest
+    middle = int(received[total // 2 - 1].split("\n")[0][len("id: "):])
+    late = broker.subscribe(last_event_id=middle)
+    replayed = []
+    while not late.queue.empty():
+        replayed.append(late.queue.get_nowait())
+
+    await backplane.stop()
+    results.put({"index": index, "received": received, "filtered": filtered, "replayed": replayed})
+
+
+def worker_main(index, workers, events, redis_url, channel, queues, ready, results):
+    if redis_url:
+        from backplane import RedisBackplane
+        backplane = RedisBackplane(url=redis_url, channel=channel, event_id_key=f"{channel}:last_id")
+    else:
+        to_sequencer, from_sequencer = queues
+        backplane = PipeBackplane(to_sequencer, from_sequencer[index])
+    asyncio.run(run_worker(index, workers, events, backplane, ready, results))
+
+
+def parse(frame):
+    lines = frame.strip().split("\n")
+    return int(lines[0][len("id: "):]), json.loads(lines[-1][len("data: "):])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--redis", help="Redis URL; omit to use the in-process sequencer")
+    args = parser.parse_args()
+
+    total = args.workers * args.events
+    ready = multiprocessing.Barrier(args.workers)
+    results = multiprocessing.Queue()
+    channel = f"sse_check:{uuid.uuid4().hex}"
+
+    queues = None
+    helpers = []
+    if not args.redis:
+        to_sequencer = multiprocessing.Queue()
+        from_sequencer = [multiprocessing.Queue() for _ in range(args.workers)]
+        queues = (to_sequencer, from_sequencer)
+        helpers.append(multiprocessing.Process(target=sequencer, args=(to_sequencer, from_sequencer, total), daemon=True))
+
+    processes = [
+        multiprocessing.Process(target=worker_main, args=(i, args.workers, args.events, args.redis, channel, queues, ready, results))
+        for i in range(args.workers)
+    ]
+    for process in helpers + processes:
+        process.start()
+    outcomes = [results.get(timeout=60) for _ in processes]
+    for process in helpers + processes:
+        process.join(timeout=10)
+
+    reference = [parse(frame)[0] for frame in outcomes[0]["received"]]
+    for outcome in outcomes:
+        events = [parse(frame) for frame in outcome["received"]]
+        ids = [event_id for event_id, _ in events]
+        assert ids == reference, f"worker {outcome['index']} saw ids in a different order"
+        assert ids == sorted(set(ids)), f"worker {outcome['index']} ids are not strictly increasing"
+        seen = {(data["worker"], data["seq"]) for _, data in events}
+        assert len(seen) == total, f"worker {outcome['index']} missed events"
+
+        filtered = [parse(frame)[1] for frame in outcome["filtered"]]
+        assert len(filtered) == total // 2 and all(d["seq"] % 2 == 0 for d in filtered), \
+            f"worker {outcome['index']} chat filter let the wrong events through"
+
+        replayed = [parse(frame)[0] for frame in outcome["replayed"]]
+        assert replayed == reference[total // 2:], f"worker {outcome['index']} replay does not continue after Last-Event-ID"
+
+    print(f"workers: {args.workers}  events per worker: {args.events}  backplane: {'redis' if args.redis else 'sequencer'}")
+    print("✅ Every worker delivered every event with the same ids, filtered per chat and replayed from Last-Event-ID")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# sse_fanout.py
+#
+# Starts the server with several uvicorn workers on the Redis backplane,
+# opens a set of /sse subscribers (spread over the workers by the kernel),
+# publishes events through /api/forcenewmessage and checks that every
+# subscriber received every event. Needs MongoDB and Redis running:
+#
+#   python benchmarks/sse_fanout.py --workers 4 --subscribers 16 --events 50
+#
+# This end-to-end run needs live services. sse_backplane_check.py covers
+# the broker's cross-process behaviour without them.
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def wait_until_up(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.3)
+    raise RuntimeError("Server did not start")
+
+
+async def subscribe(base_url, received, ready, index):
+    async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+        async with client.stream("GET", "/sse") as response:
+            ready.release()
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    received[index].add(json.loads(line[6:])["_id"])
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--subscribers", type=int, default=16)
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--port", type=int, default=5099)
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    env = {**os.environ, "SSE_BACKPLANE": "redis", "WEB_CONCURRENCY": str(args.workers)}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--workers", str(args.workers)],
+        cwd=ROOT,
+        env=env
+    )
+
+    try:
+        await wait_until_up(base_url)
+
+        received = [set() for _ in range(args.subscribers)]
+        ready = asyncio.Semaphore(0)
+        tasks = [asyncio.create_task(subscribe(base_url, received, ready, i)) for i in range(args.subscribers)]
+        for _ in range(args.subscribers):
+            await ready.acquire()
+
+        published = set()
+        async with httpx.AsyncClient(base_url=base_url) as client:
+            for _ in range(args.events):
+                response = await client.get("/api/forcenewmessage")
+                published.add(response.json()["message"]["_id"])
+
+        # Give the backplane a moment to drain
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and any(r != published for r in received):
+            await asyncio.sleep(0.2)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        missing = [len(published - r) for r in received]
+        print(f"workers: {args.workers} subscribers: {args.subscribers} events: {len(published)}")
+        print(f"missing per subscriber: {missing}")
+        if any(missing):
+            print("❌ Some subscribers missed events")
+            sys.exit(1)
+        print("✅ Every subscriber received every event")
+
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,6 @@
 import os
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
-client = MongoClient(MONGO_URL)
-db = client["whatsapp"]
\ No newline at end of file
+client = AsyncIOMotorClient(MONGO_URL)
+db = client["whatsapp"]
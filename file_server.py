@@ -0,0 +1,377 @@
+# file_server.py
+#
+# Serving of stored files for /download and the /uploads mount:
+# an in-memory name -> path index (built at startup, updated whenever
+# remember_media records a new artifact, checked against disk on a miss
+# since each worker has its own copy), strong ETags taken from the
+# sha256 in content-addressed names, If-None-Match -> 304, and single
+# byte-range (206) responses so video seeking and resumed downloads
+# only move the bytes asked for.
+#
+# Hash-named files never change, so they are marked immutable for a year.
+# Large bodies can be handed to the reverse proxy (X-Accel-Redirect) so it
+# sendfile()s them, and compressible documents get gzip/brotli variants
+# written once to uploads/compressed.
+#
+#   python file_server.py precompress   # backfill variants for existing files
+
+import asyncio
+import gzip
+import mimetypes
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+
+from fastapi import HTTPException
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.requests import Request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Same base as every writer (and the /uploads mount): "uploads" under the working directory
+UPLOADS_DIR = os.path.abspath("uploads")
+
+# Lookup order of the old /download probe; the first directory holding a name wins
+FILE_DIRS = [
+    os.path.join(UPLOADS_DIR, "messages"),
+    os.path.join(UPLOADS_DIR, "temporalFiles", "documents"),
+    os.path.join(UPLOADS_DIR, "temporalFiles", "images"),
+    os.path.join(UPLOADS_DIR, "temporalFiles", "videos"),
+    os.path.join(UPLOADS_DIR, "permanentFiles"),
+]
+
+HASH_NAME = re.compile(r"^([0-9a-f]{64})(\.|$)")
+RANGE_CHUNK_SIZE = 256 * 1024
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Other names may be replaced in place: cache, but check the ETag every time
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# e.g. "/_uploads/" with an nginx "internal" location aliased to uploads/
+UPLOADS_ACCEL_PREFIX = os.getenv("UPLOADS_ACCEL_PREFIX")
+SENDFILE_MIN_BYTES = int(os.getenv("SENDFILE_MIN_BYTES", str(1024 * 1024)))
+
+COMPRESSED_DIR = os.path.join(UPLOADS_DIR, "compressed")
+PRECOMPRESS_MIN_BYTES = 1024
+# Larger files are served as-is; compressing them would take minutes
+PRECOMPRESS_MAX_BYTES = int(os.getenv("PRECOMPRESS_MAX_BYTES", str(32 * 1024 * 1024)))
+PRECOMPRESS_CHUNK_SIZE = 1024 * 1024
+# 11 is several times slower than 9 for a few percent on text
+BROTLI_QUALITY = 9
+# Only formats that aren't compressed already (no images, video, zip-based office files)
+COMPRESSIBLE_TYPES = {
+    "text/plain",
+    "text/csv",
+    "text/html",
+    "text/xml",
+    "text/markdown",
+    "text/javascript",
+    "application/json",
+    "application/xml",
+    "application/javascript",
+    "application/rtf",
+    "application/msword",
+    "application/vnd.ms-excel",
+    "application/vnd.ms-powerpoint",
+    "image/svg+xml",
+}
+# Preferred first
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+
+class FileIndex:
+    def __init__(self, directories):
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.paths = {}  # name -> absolute path
+
+    def priority(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        return self.directories.index(directory) if directory in self.directories else len(self.directories)
+
+    def build(self):
+        paths = {}
+        for directory in reversed(self.directories):
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    paths[entry.name] = entry.path
+        self.paths = paths
+        print(f"🗂️ File index built: {len(paths)} files")
+
+    def add(self, path):
+        name = os.path.basename(path)
+        current = self.paths.get(name)
+        if current is None or self.priority(path) <= self.priority(current):
+            self.paths[name] = os.path.abspath(path)
+
+    def remove(self, path):
+        name = os.path.basename(path)
+        if self.paths.get(name) == os.path.abspath(path):
+            del self.paths[name]
+
+    def resolve(self, name):
+        if not name or os.path.basename(name) != name or name in (".", ".."):
+            return None
+        path = self.paths.get(name)
+        if path and os.path.isfile(path):
+            return path
+
+        # Missing or stale: another worker (or the storage collector) may have
+        # written or moved it since this index was built, so look on disk
+        self.paths.pop(name, None)
+        for directory in self.directories:
+            candidate = os.path.join(directory, name)
+            if os.path.isfile(candidate):
+                self.paths[name] = candidate
+                return candidate
+        return None
+
+
+file_index = FileIndex(FILE_DIRS)
+
+
+def file_etag(path, stat):
+    # Content-addressed names carry their sha256; anything else is only ever
+    # replaced atomically, so size + mtime identify its bytes
+    match = HASH_NAME.match(os.path.basename(path))
+    if match:
+        return f'"{match.group(1)}"'
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def cache_control(path):
+    return IMMUTABLE_CACHE_CONTROL if HASH_NAME.match(os.path.basename(path)) else REVALIDATE_CACHE_CONTROL
+
+
+def media_type_of(path):
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+precompress_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="precompress")
+
+
+def variant_path(path, suffix):
+    return os.path.join(COMPRESSED_DIR, os.path.basename(path) + suffix)
+
+
+def compress_file(path, target, encoding):
+    # Streams in chunks, so memory stays flat whatever the file size
+    with open(path, "rb") as src, open(target, "wb") as dst:
+        chunks = iter(lambda: src.read(PRECOMPRESS_CHUNK_SIZE), b"")
+        if encoding == "gzip":
+            with gzip.GzipFile(filename="", fileobj=dst, mode="wb", compresslevel=9, mtime=0) as gz:
+                for chunk in chunks:
+                    gz.write(chunk)
+        else:
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            for chunk in chunks:
+                dst.write(compressor.process(chunk))
+            dst.write(compressor.finish())
+
+
+def precompress(path):
+    # Writes {name}.gz / {name}.br when that actually saves space
+    try:
+        size = os.path.getsize(path)
+        if media_type_of(path) not in COMPRESSIBLE_TYPES or not PRECOMPRESS_MIN_BYTES <= size <= PRECOMPRESS_MAX_BYTES:
+            return
+        os.makedirs(COMPRESSED_DIR, exist_ok=True)
+
+        for encoding, suffix in ENCODINGS:
+            if encoding == "br" and brotli is None:
+                continue
+            target = variant_path(path, suffix)
+            compress_file(path, f"{target}.part", encoding)
+            if os.path.getsize(f"{target}.part") > size * 0.9:
+                os.remove(f"{target}.part")
+                continue
+            os.replace(f"{target}.part", target)
+    except Exception as e:
+        print(f"⚠️ Could not precompress {path}: {e}")
+
+
+def precompress_in_background(path):
+    # Fire and forget on its own thread, so a big document never ties up the
+    # default executor that hashing, thumbnails and the GC scan share
+    asyncio.get_running_loop().run_in_executor(precompress_executor, precompress, path)
+
+
+def accepted_encodings(header):
+    accepted = set()
+    for part in (header or "").split(","):
+        token, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(token.strip().lower())
+    return accepted
+
+
+def pick_variant(path, stat, accept_encoding):
+    accepted = accepted_encodings(accept_encoding)
+    for encoding, suffix in ENCODINGS:
+        if encoding not in accepted:
+            continue
+        candidate = variant_path(path, suffix)
+        try:
+            candidate_stat = os.stat(candidate)
+        except FileNotFoundError:
+            continue
+        # A variant older than its source belongs to previous contents
+        if candidate_stat.st_mtime_ns >= stat.st_mtime_ns:
+            return encoding, candidate, candidate_stat
+    return None
+
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+
+def parse_range(header, size):
+    # Returns (start, end) inclusive, or None to send the whole file
+    if not header or not header.startswith("bytes="):
+        return None
+    ranges = header[len("bytes="):].split(",")
+    if len(ranges) != 1:
+        return None  # multipart/byteranges isn't worth it; a 200 is always allowed
+
+    start, _, end = ranges[0].strip().partition("-")
+    try:
+        if start == "":
+            suffix = int(end)
+            start, end = max(0, size - suffix), size - 1
+            if suffix == 0:
+                start = size
+        else:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+
+    if start >= size or end < start:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+def iter_file_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_response(request_headers, path, stat=None, filename=None, media_type=None, headers=None):
+    stat = stat or os.stat(path)
+    etag = file_etag(path, stat)
+    media_type = media_type or media_type_of(path)
+    response_headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": cache_control(path),
+        **(headers or {})
+    }
+
+    # Ranges address the identity bytes, so a ranged request never gets a variant
+    encoding = None
+    if media_type_of(path) in COMPRESSIBLE_TYPES:
+        response_headers["Vary"] = "Accept-Encoding"
+        variant = None if request_headers.get("range") else pick_variant(path, stat, request_headers.get("accept-encoding"))
+        if variant:
+            encoding, path, stat = variant
+            etag = f'{etag[:-1]}-{encoding}"'
+            response_headers["ETag"] = etag
+            response_headers["Content-Encoding"] = encoding
+
+    if etag_matches(request_headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=response_headers)
+
+    if UPLOADS_ACCEL_PREFIX and not encoding and stat.st_size >= SENDFILE_MIN_BYTES:
+        # The proxy sendfile()s the body and handles Range on its own
+        relative = os.path.relpath(os.path.abspath(path), UPLOADS_DIR).replace(os.sep, "/")
+        response_headers["X-Accel-Redirect"] = UPLOADS_ACCEL_PREFIX.rstrip("/") + "/" + relative
+        if filename and "Content-Disposition" not in response_headers:
+            response_headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return Response(media_type=media_type, headers=response_headers)
+
+    # If-Range: only honor the range when the client still has this exact version
+    byte_range = None
+    if_range = request_headers.get("if-range")
+    if if_range is None or if_range.strip() == etag:
+        byte_range = parse_range(request_headers.get("range"), stat.st_size)
+
+    if byte_range is None:
+        # Starlette hands the path to the server (http.response.pathsend) when it can
+        return FileResponse(path, stat_result=stat, filename=filename, media_type=media_type, headers=response_headers)
+
+    start, end = byte_range
+    response_headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    response_headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file_range(path, start, end),
+        status_code=206,
+        media_type=media_type,
+        headers=response_headers
+    )
+
+
+class UploadFiles(StaticFiles):
+    # StaticFiles still resolves the path safely; only the response changes
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        try:
+            return file_response(Request(scope).headers, full_path, stat_result)
+        except HTTPException as e:
+            return Response(status_code=e.status_code, headers=e.headers)
+
+    async def get_response(self, path, scope):
+        try:
+            return await super().get_response(path, scope)
+        except StarletteHTTPException as e:
+            # Files promoted out of temporalFiles keep answering on their old,
+            # immutable-cached URLs; the index finds them in permanentFiles
+            parts = path.replace(os.sep, "/").split("/")
+            if e.status_code != 404 or parts[0] != "temporalFiles":
+                raise
+            moved = file_index.resolve(parts[-1])
+            if not moved:
+                raise
+            return self.file_response(moved, os.stat(moved), scope)
+
+
+def precompress_all():
+    count = 0
+    for directory in FILE_DIRS:
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if entry.is_file() and media_type_of(entry.path) in COMPRESSIBLE_TYPES:
+                precompress(entry.path)
+                count += 1
+    print(f"✅ Precompressed {count} files" + ("" if brotli else " (gzip only, brotli not installed)"))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["precompress"]:
+        precompress_all()
+    else:
+        print("usage: python file_server.py precompress")
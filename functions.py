@@ -1,18 +1,23 @@
 import os
 import subprocess
-import requests
 import uuid
 import json
 import asyncio
+import hashlib
 import mimetypes
+import magic
+from contextlib import asynccontextmanager
 
 from db import db
+from pymongo import ReturnDocument
 from dotenv import load_dotenv
-from sse import connected_clients
-from datetime import datetime
+from sse import broker
+from graph_api import graph
+from datetime import datetime, timedelta
 
-from PIL import Image
+from PIL import Image, ImageOps
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 
@@ -20,9 +25,32 @@ ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
 WHATSAPP_API_URL = os.getenv("WHATSAPP_API_URL")
 YOUR_PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "https://bricopoxi.com")
 
+# Cloud API limit for video and audio
+WHATSAPP_MEDIA_MAX_BYTES = 16 * 1024 * 1024
 
-def send_whatsapp_message(to, text=None, reaction=None, reply_to=None, media_type=None, media_url=None, media_filename=None, auto_save=False):
+# Longest side of sanitized images; larger photos are downscaled
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "2048"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MIME_SNIFF_SIZE = 8192
+
+# An allocated chat version not released after this long belongs to a dead
+# worker and stops holding back the safe version
+CHAT_VERSION_LEASE_SECONDS = int(os.getenv("CHAT_VERSION_LEASE_SECONDS", "60"))
+
+# Cloud API keeps uploaded media for 30 days; reuse ids a bit less than that
+WHATSAPP_MEDIA_TTL = timedelta(days=int(os.getenv("WHATSAPP_MEDIA_TTL_DAYS", "25")))
+media_upload_locks = {}  # sha256 -> [lock, callers holding or waiting on it]
+# Graph error codes for media that can't be found or fetched by id
+MEDIA_ID_ERROR_CODES = {131052, 131053}
+media_upload_stats = {"hits": 0, "misses": 0}
+
+
+async def send_whatsapp_message(to, text=None, reaction=None, reply_to=None, media_type=None, media_url=None, media_filename=None, media_hash=None, auto_save=False):
 
     if reaction:
         data = {
@@ -39,8 +67,8 @@ def send_whatsapp_message(to, text=None, reaction=None, reply_to=None, media_typ
     elif media_type and media_url:
         # Assume media_url is a local path to file, not a public link
         mime_type = get_mime_type(media_url)  # You can use mimetypes module
-        media_id = upload_media_to_whatsapp(media_url, mime_type)
-        
+        media_id, media_hash = await get_whatsapp_media_id(media_url, mime_type, media_hash)
+
         if not media_id:
             print("❌ Failed to upload media to WhatsApp")
             return None
@@ -81,10 +109,14 @@ def send_whatsapp_message(to, text=None, reaction=None, reply_to=None, media_typ
             data["context"] = {"message_id": reply_to}
         content = text
 
-    response = send_to_whatsapp_api(data)
+    response = await send_to_whatsapp_api(data)
+    if not reaction and media_type and media_url and media_id_rejected(response):
+        # Meta purged the cached media id; upload again next time
+        await db.whatsapp_media.delete_one({"_id": media_hash})
+
     waba_id = extract_waba_message_id(response)
     if auto_save:
-        save_message_to_db(
+        await save_message_to_db(
             to=to,
             sender="me",
             content=content,
@@ -95,16 +127,25 @@ def send_whatsapp_message(to, text=None, reaction=None, reply_to=None, media_typ
     return response
 
 
+def outgoing_content(text=None, reaction=None, media_type=None, media_url=None, **_):
+    # What send_whatsapp_message stores as content for the same arguments
+    if reaction:
+        return f"[reaction] {reaction}"
+    if media_type and media_url:
+        return f"[{media_type}] {media_url}"
+    return text
+
+
 # SEND MESSAGE PARTS
 
-def send_to_whatsapp_api(data):
+async def send_to_whatsapp_api(data):
     headers = {
         "Authorization": f"Bearer {ACCESS_TOKEN}",
         "Content-Type": "application/json"
     }
 
     try:
-        response = requests.post(WHATSAPP_API_URL, headers=headers, json=data)
+        response = await graph.post(WHATSAPP_API_URL, headers=headers, json=data)
         print(f"📤 Sent to WhatsApp API | Status: {response.status_code} | {response.text}")
         return response
     except Exception as e:
@@ -120,18 +161,18 @@ def extract_waba_message_id(response):
         print(f"⚠️ Could not extract WABA message ID: {e}")
     return None
 
-def save_message_to_db(to, sender, content, file=None, file_name=None, reference_id=None, waba_id=None):
-    ensure_chat_exists(to)  # 💬 Make sure chat exists before saving the message
+async def save_message_to_db(to, sender, content, file=None, file_name=None, reference_id=None, waba_id=None):
+    await ensure_chat_exists(to)  # 💬 Make sure chat exists before saving the message
 
     message_id = str(uuid.uuid4())
-    now_iso = datetime.utcnow()
+    now = datetime.utcnow()
 
     db_entry = {
         "_id": message_id,
         "chatWaId": to,
         "sender": sender,
         "content": content,
-        "timestamp": {"$date": now_iso},
+        "timestamp": now,
         "status": "sent",
         "file": file,
         "fileName": file_name,
@@ -141,34 +182,148 @@ def save_message_to_db(to, sender, content, file=None, file_name=None, reference
     if waba_id:
         db_entry["wabaMessageId"] = waba_id
 
-    db.messages.insert_one(db_entry)
+    await db.messages.insert_one(db_entry)
 
     # Optionally update the chat with the last message and timestamp
-    db.chats.update_one(
-        {"waId": to},
-        {
-            "$set": {
-                "lastMessage": content,
-                "timestamp": {"$date": now_iso},
-                "unreadCount": 0  # This might change if it's incoming
+    async with chat_version() as version:
+        await db.chats.update_one(
+            {"waId": to},
+            {
+                "$set": {
+                    "lastMessage": content,
+                    "timestamp": now,
+                    "unreadCount": 0,  # This might change if it's incoming
+                    "version": version
+                }
             }
-        }
-    )
+        )
 
     # Send to frontend
-    payload = json.dumps(db_entry, default=str)
-    for client in connected_clients:
-        asyncio.create_task(await_safe_put(client, payload))
+    broker.publish(db_entry, chat_id=to)
 
     return message_id
 
 
 
 
+async def stream_upload(upload, dest_dir):
+    # Copy an UploadFile to dest_dir in chunks, hashing as we go.
+    # Returns (path, sha256, size, mime_type); only the first few KB are sniffed.
+    # Starlette has already spooled the whole multipart body to a temp file by
+    # the time the handler runs, so this is a second, constant-memory copy made
+    # after the upload ends, not a copy as the bytes arrive.
+    os.makedirs(dest_dir, exist_ok=True)
+    ext = os.path.splitext(upload.filename or "")[1]
+    path = os.path.join(dest_dir, f"{uuid.uuid4().hex}{ext}")
+
+    sha256 = hashlib.sha256()
+    size = 0
+    head = b""
+    with open(path, "wb") as f:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            if len(head) < MIME_SNIFF_SIZE:
+                head += chunk[:MIME_SNIFF_SIZE - len(head)]
+            sha256.update(chunk)
+            size += len(chunk)
+            f.write(chunk)
+
+    mime_type = magic.from_buffer(head, mime=True) if head else "application/octet-stream"
+    return path, sha256.hexdigest(), size, mime_type
+
+
+def public_file_url(category, file_name):
+    return f"{PUBLIC_BASE_URL}/uploads/temporalFiles/{category}/{file_name}"
+
+
+def media_type_for(file_url):
+    # Determine WhatsApp media type from file extension
+    if file_url.endswith(('.jpg', '.jpeg', '.png')):
+        return "image"
+    elif file_url.endswith('.mp4'):
+        return "video"
+    elif file_url.endswith('.ogg'):
+        return "audio"
+    return "document"
+
+
+def probe_media(file_path):
+    # One ffprobe call; everything later decisions need comes from here
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_streams", "-show_format", "-print_format", "json", file_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        info = json.loads(result.stdout or "{}")
+    except Exception as e:
+        print(f"ffprobe error: {e}")
+        info = {}
+
+    streams = info.get("streams", [])
+    fmt = info.get("format", {})
+    # Cover art in audio files shows up as a video stream
+    video = next((s for s in streams if s.get("codec_type") == "video" and not s.get("disposition", {}).get("attached_pic")), None)
+    audio_streams = [s for s in streams if s.get("codec_type") == "audio"]
+
+    return {
+        "formatName": fmt.get("format_name", ""),
+        "duration": float(fmt["duration"]) if fmt.get("duration") else None,
+        "size": os.path.getsize(file_path),
+        "videoCodec": video.get("codec_name") if video else None,
+        "pixFmt": video.get("pix_fmt") if video else None,
+        "width": video.get("width") if video else None,
+        "height": video.get("height") if video else None,
+        "audioCodec": audio_streams[0].get("codec_name") if audio_streams else None,
+        "audioStreams": len(audio_streams)
+    }
+
+
+def plan_media(probe, ext):
+    # Returns (category, plan) where plan is "passthrough", "remux" or "transcode"
+    formats = probe["formatName"].split(",")
+    size_ok = probe["size"] <= WHATSAPP_MEDIA_MAX_BYTES
+
+    if probe["videoCodec"]:
+        compliant = (
+            size_ok
+            and probe["videoCodec"] == "h264"
+            and probe["pixFmt"] in ("yuv420p", None)
+            and probe["audioCodec"] in ("aac", None)
+            and probe["audioStreams"] <= 1
+        )
+        if not compliant:
+            return "videos", "transcode"
+        # ffprobe reports mov and mp4 alike, so only trust an .mp4 name
+        return "videos", "passthrough" if "mp4" in formats and ext.lower() == ".mp4" else "remux"
+
+    if probe["audioCodec"] == "opus" and size_ok:
+        return "documents", "passthrough" if "ogg" in formats else "remux"
+
+    return "documents", "transcode"
+
+
+def remux_media(input_path, output_path, container):
+    # Change container only (-c copy): no decoding or encoding
+    command = ["ffmpeg", "-y", "-i", input_path, "-map", "0:v?", "-map", "0:a?", "-c", "copy"]
+    if container == "mp4":
+        command += ["-movflags", "+faststart"]
+    command += ["-f", container, output_path]
+    try:
+        subprocess.run(command, check=True)
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"❌ Remux failed: {e}")
+        return False
+
+
 def convert_to_whatsapp_video(input_path: str, output_path: str):
     try:
         command = [
-            "ffmpeg",
+            "ffmpeg", "-y",
             "-i", input_path,
             "-vf", "scale=w=1280:h=720:force_original_aspect_ratio=decrease",
             "-c:v", "libx264",
@@ -205,20 +360,15 @@ def convert_audio_to_ogg(input_path, output_path):
         print(f"❌ Audio conversion failed: {e}")
         return False
 
-def ensure_chat_exists(wa_id, is_group=False, group_name=None):
-    existing_chat = db.chats.find_one({"waId": wa_id})
-    if existing_chat:
-        return existing_chat["_id"]
-
-    now_iso = datetime.utcnow()
-    chat_data = {
+def new_chat_defaults(is_group=False, group_name=None):
+    # Fields of a freshly created chat, minus waId (used with $setOnInsert)
+    return {
         "_id": uuid.uuid4().hex,
-        "waId": wa_id,
         "isGroup": is_group,
         "groupName": group_name,
         "lastMessage": "",
         "participants": [],
-        "timestamp": {"$date": now_iso},
+        "timestamp": datetime.utcnow(),
         "unreadCount": 0,
         "isTyping": False,
         "isMuted": False,
@@ -226,40 +376,162 @@ def ensure_chat_exists(wa_id, is_group=False, group_name=None):
         "isBlocked": False
     }
 
-    db.chats.insert_one(chat_data)
-    print(f"💬 Created new chat with {wa_id}")
-    return chat_data["_id"]
 
+@asynccontextmanager
+async def chat_version(count=1):
+    # Global, strictly increasing chat version; allocates `count` and yields the last one.
+    # Every write to db.chats stores one (inside this block) so /api/chats/changes can find it.
+    # Versions stay "in flight" until the block exits, because writes can land out of
+    # allocation order; safe_chat_version never hands clients a mark past one of them.
+    now = datetime.utcnow()
+    counter = await db.counters.find_one_and_update(
+        {"_id": "chatVersion"},
+        [
+            {"$set": {"seq": {"$add": [{"$ifNull": ["$seq", 0]}, count]}}},
+            {"$set": {"inflight": {"$concatArrays": [
+                {"$ifNull": ["$inflight", []]},
+                [{"v": {"$subtract": ["$seq", count - 1]}, "at": now}]
+            ]}}}
+        ],
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    last = counter["seq"]
+    try:
+        yield last
+    finally:
+        await db.counters.update_one({"_id": "chatVersion"}, {"$pull": {"inflight": {"v": last - count + 1}}})
+
+
+async def safe_chat_version():
+    # Highest version below every in-flight one: every chat write up to it has landed
+    counter = await db.counters.find_one({"_id": "chatVersion"})
+    if not counter:
+        return 0
+    cutoff = datetime.utcnow() - timedelta(seconds=CHAT_VERSION_LEASE_SECONDS)
+    inflight = counter.get("inflight", [])
+    live = [entry["v"] for entry in inflight if entry["at"] >= cutoff]
+    if len(live) < len(inflight):
+        await db.counters.update_one({"_id": "chatVersion"}, {"$pull": {"inflight": {"at": {"$lt": cutoff}}}})
+    return min(live) - 1 if live else counter["seq"]
+
+
+async def bump_chat_version(wa_id):
+    # For writes that only know afterwards whether they changed the chat;
+    # never lowers a newer version another write already stored
+    async with chat_version() as version:
+        await db.chats.update_one(
+            {"waId": wa_id, "version": {"$not": {"$gte": version}}},
+            {"$set": {"version": version}}
+        )
 
 
-async def await_safe_put(client, data):
-    try:
-        await client.put(data)
-    except Exception as e:
-        print(f"⚠️ Failed to push to client: {e}")
+async def ensure_chat_exists(wa_id, is_group=False, group_name=None):
+    # Upsert so concurrent webhooks can't trip the unique waId index
+    result = await db.chats.update_one(
+        {"waId": wa_id},
+        {"$setOnInsert": new_chat_defaults(is_group, group_name)},
+        upsert=True
+    )
+    if result.upserted_id is None:
+        existing_chat = await db.chats.find_one({"waId": wa_id}, {"_id": 1})
+        return existing_chat["_id"]
+
+    # Only a real insert is a change
+    await bump_chat_version(wa_id)
+    print(f"💬 Created new chat with {wa_id}")
+    return result.upserted_id
 
 
-def upload_media_to_whatsapp(file_path, mime_type):
-    url = f"https://graph.facebook.com/v19.0/{os.getenv('PHONE_NUMBER_ID')}/media"  # Replace with actual phone number ID
+
+async def upload_media_to_whatsapp(file_path, mime_type):
+    url = f"/{os.getenv('PHONE_NUMBER_ID')}/media"
     headers = {
         "Authorization": f"Bearer {ACCESS_TOKEN}"
     }
 
-    with open(file_path, 'rb') as f:
-        files = {
-            'file': (os.path.basename(file_path), f, mime_type)
-        }
-        data = {
-            'messaging_product': 'whatsapp',
-            'type': mime_type
-        }
-
-        response = requests.post(url, headers=headers, files=files, data=data)
-        print(f"📤 Upload media response: {response.status_code} - {response.text}")
+    data = {
+        'messaging_product': 'whatsapp',
+        'type': mime_type
+    }
 
-        if response.status_code == 200:
-            return response.json().get('id')  # media_id
+    # httpx streams the file into the multipart body in chunks; the client
+    # rewinds it before a retry
+    try:
+        with open(file_path, 'rb') as f:
+            files = {
+                'file': (os.path.basename(file_path), f, mime_type)
+            }
+            response = await graph.post(url, headers=headers, files=files, data=data)
+    except Exception as e:
+        print(f"❌ Error uploading media to WhatsApp API: {e}")
         return None
+    print(f"📤 Upload media response: {response.status_code} - {response.text}")
+
+    if response.status_code == 200:
+        return response.json().get('id')  # media_id
+    return None
+
+
+async def get_whatsapp_media_id(file_path, mime_type, file_hash=None):
+    # Returns (media_id, sha256); uploads only when no unexpired id is cached for these bytes.
+    # Callers pass the hash they already know (content-addressed names); hashing the
+    # file here is only for outbox items queued without one.
+    if not file_hash:
+        file_hash = await asyncio.to_thread(file_sha256, file_path)
+
+    # One upload per file at a time; concurrent sends of the same file wait for it.
+    # The lock is dropped with its last user, so a newcomer never gets a second one.
+    lock_entry = media_upload_locks.setdefault(file_hash, [asyncio.Lock(), 0])
+    lock_entry[1] += 1
+    try:
+        async with lock_entry[0]:
+            now = datetime.utcnow()
+            cached = await db.whatsapp_media.find_one({"_id": file_hash, "expiresAt": {"$gt": now}})
+            if cached:
+                media_upload_stats["hits"] += 1
+                return cached["mediaId"], file_hash
+
+            media_upload_stats["misses"] += 1
+            media_id = await upload_media_to_whatsapp(file_path, mime_type)
+            if media_id:
+                await db.whatsapp_media.update_one(
+                    {"_id": file_hash},
+                    {"$set": {
+                        "mediaId": media_id,
+                        "mimeType": mime_type,
+                        "uploadedAt": now,
+                        "expiresAt": now + WHATSAPP_MEDIA_TTL
+                    }},
+                    upsert=True
+                )
+            return media_id, file_hash
+    finally:
+        lock_entry[1] -= 1
+        if lock_entry[1] == 0:
+            media_upload_locks.pop(file_hash, None)
+
+
+def media_id_rejected(response):
+    # True only when Graph says the media id itself is unknown or expired;
+    # throttling, 5xx and transport errors say nothing about the cached id
+    if response is None or response.status_code not in (400, 404):
+        return False
+    try:
+        error = response.json().get("error", {})
+    except Exception:
+        return False
+    code = error.get("code")
+    message = str(error.get("message", "")).lower()
+    return code in MEDIA_ID_ERROR_CODES or (code == 100 and "media" in message)
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
 
 def get_mime_type(file_path):
@@ -268,12 +540,38 @@ def get_mime_type(file_path):
 
 
 
-def sanitize_image(image_bytes, output_path):
+def is_clean_jpeg(img):
+    # Already a plain baseline-sized JPEG with no metadata worth stripping
+    return (
+        img.format == "JPEG"
+        and img.mode in ("RGB", "L")
+        and max(img.size) <= IMAGE_MAX_EDGE
+        and not any(key in img.info for key in ("exif", "comment", "photoshop", "xmp"))
+    )
+
+
+def sanitize_image(input_path, output_path):
+    # Consumes input_path on success; leaves it in place on failure
     try:
-        with Image.open(BytesIO(image_bytes)) as img:
+        with Image.open(input_path) as img:
+            if is_clean_jpeg(img):
+                os.replace(input_path, output_path)
+                return True
+
+            # Let the JPEG decoder downscale by 1/2, 1/4 or 1/8 while decoding
+            img.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+            img = ImageOps.exif_transpose(img)
+            if max(img.size) > IMAGE_MAX_EDGE:
+                img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
             rgb_image = img.convert("RGB")  # Ensure RGB format
             rgb_image.save(output_path, format="JPEG", quality=85)
+        os.remove(input_path)
         return True
     except Exception as e:
         print(f"❌ Failed to sanitize image: {e}")
-        return False
\ No newline at end of file
+        return False
+
+
+async def sanitize_image_async(input_path, output_path):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(image_executor, sanitize_image, input_path, output_path)
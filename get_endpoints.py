@@ -1,15 +1,169 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Query
 from fastapi.responses import PlainTextResponse, FileResponse
-from datetime import datetime
+from datetime import datetime, timezone
 
 from db import db
+from migrate_timestamps import parse_legacy_timestamp
+from functions import bump_chat_version, safe_chat_version
+from file_server import file_index, file_response
+from media_cache import cache_stats
+from thumbnails import get_thumbnail, snap_width, DEFAULT_THUMB_WIDTH
+from search import search_messages, search_terms, make_snippet, SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE
 
 import os
+import json
+import base64
 
 ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
 WHATSAPP_API_URL = os.getenv("WHATSAPP_API_URL")
 
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 200
+
+# Only the fields the chat view renders
+MESSAGE_LIST_PROJECTION = {
+    "chatWaId": 1,
+    "sender": 1,
+    "content": 1,
+    "timestamp": 1,
+    "status": 1,
+    "file": 1,
+    "fileName": 1,
+    "fileStatus": 1,
+    "referenceContent": 1,
+    "reactions": 1,
+    "media": 1,
+    "thumbnail": 1
+}
+
+
+CHATS_PAGE_SIZE = 50
+CHATS_MAX_PAGE_SIZE = 200
+
+# Only the fields the chat list renders
+CHAT_LIST_PROJECTION = {
+    "waId": 1,
+    "isGroup": 1,
+    "groupName": 1,
+    "groupPicture": 1,
+    "participants": 1,
+    "lastMessage": 1,
+    "timestamp": 1,
+    "unreadCount": 1,
+    "isTyping": 1,
+    "isPinned": 1,
+    "isMuted": 1,
+    "isBlocked": 1,
+    "version": 1,
+    "contact.name": 1,
+    "contact.profilePic": 1,
+    "participantContacts.waId": 1,
+    "participantContacts.name": 1
+}
+
+CHAT_LOOKUP_STAGES = [
+    {"$lookup": {
+        "from": "contacts",
+        "localField": "waId",
+        "foreignField": "waId",
+        "as": "contact"
+    }},
+    {"$lookup": {
+        "from": "contacts",
+        "localField": "participants.waId",
+        "foreignField": "waId",
+        "as": "participantContacts"
+    }},
+    {"$project": CHAT_LIST_PROJECTION}
+]
+
+# Sort order of the chat list: pinned first, then chats with isPinned False, then legacy docs without the flag
+PINNED_GROUPS = [True, False, None]
+
+
+def to_millis(dt):
+    # Mongo hands back naive datetimes that are already UTC.
+    # Legacy values that slipped past migrate_timestamps must not 500 a whole page.
+    if not isinstance(dt, datetime):
+        dt = parse_legacy_timestamp(dt)
+        if dt is None:
+            return 0
+    return int(dt.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def encode_cursor(raw):
+    # Opaque cursor; datetimes are kept as ISO strings under "t"
+    timestamp = raw.get("t")
+    if isinstance(timestamp, datetime):
+        raw = {**raw, "t": timestamp.isoformat()}
+    return base64.urlsafe_b64encode(json.dumps(raw, default=str).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(raw.get("t"), str):
+            raw["t"] = datetime.fromisoformat(raw["t"])
+        return raw
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def chat_page_match(cursor):
+    # Keyset condition for "everything after this chat" in (isPinned, timestamp, _id) order
+    pinned, timestamp, chat_id = cursor.get("p"), cursor["t"], cursor["id"]
+    later_groups = PINNED_GROUPS[PINNED_GROUPS.index(pinned) + 1:]
+    return {"$or": [
+        {"isPinned": pinned, "timestamp": {"$lt": timestamp}},
+        {"isPinned": pinned, "timestamp": timestamp, "_id": {"$lt": chat_id}},
+        *({"isPinned": group} for group in later_groups)
+    ]}
+
+
+def format_chat(chat_doc):
+    wa_id = chat_doc["waId"]
+    is_group = chat_doc.get("isGroup", False)
+    chat_name = "Unknown"
+    chat_picture = None
+    participants_list = []
+
+    if is_group:
+        chat_name = chat_doc.get("groupName", "Group Chat")
+        chat_picture = chat_doc.get("groupPicture")
+        participant_names = {c["waId"]: c.get("name") for c in chat_doc.get("participantContacts", [])}
+        for p_raw in chat_doc.get("participants", []):
+            participants_list.append({
+                "waId": p_raw["waId"],
+                "name": participant_names.get(p_raw["waId"]) or p_raw.get("name", p_raw["waId"]),
+                "isAdmin": p_raw.get("isAdmin", True)
+            })
+
+    else:
+        contact = (chat_doc.get("contact") or [None])[0]
+        if contact:
+            chat_name = contact.get("name", "Unknown Contact")
+            chat_picture = contact.get("profilePic")
+        else:
+            chat_name = wa_id
+
+    return {
+        "id": wa_id,
+        "name": chat_name,
+        "picture": chat_picture,
+        "lastMessage": chat_doc.get("lastMessage", ""),
+        "timestamp": to_millis(chat_doc.get("timestamp")),
+        "unreadCount": chat_doc.get("unreadCount", 0),
+        "isTyping": chat_doc.get("isTyping", False),
+        "isGroup": is_group,
+        "participants": participants_list if is_group else [],
+        "isPinned": chat_doc.get("isPinned", False),
+        "isMuted": chat_doc.get("isMuted", False),
+        "isBlocked": chat_doc.get("isBlocked", False),
+        "version": chat_doc.get("version", 0)
+    }
+
+
 def register_get_endpoints(app: FastAPI):
     @app.get("/")
     async def root():
@@ -21,34 +175,14 @@ def register_get_endpoints(app: FastAPI):
         }
 
     @app.get("/download/{file_name}")
-    def download_file(file_name: str):
-        print("downloading?")
-        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-        UPLOAD_DIR = os.path.join(BASE_DIR, "uploads", "messages")
-        file_path = os.path.join(UPLOAD_DIR, file_name)
-        
-        if not os.path.exists(file_path):
-            UPLOAD_DIR = os.path.join(BASE_DIR, "uploads", "temporalFiles")
-            REAL_UPLOAD_DIR = os.path.join(UPLOAD_DIR, "documents")
-            file_path = os.path.join(REAL_UPLOAD_DIR, file_name)
-
-            if not os.path.exists(file_path):
-                REAL_UPLOAD_DIR = os.path.join(UPLOAD_DIR, "images")
-                file_path = os.path.join(REAL_UPLOAD_DIR, file_name)
-
-                if not os.path.exists(file_path):
-                    REAL_UPLOAD_DIR = os.path.join(UPLOAD_DIR, "videos")
-                    file_path = os.path.join(REAL_UPLOAD_DIR, file_name)
-
-                    if not os.path.exists(file_path):
-                        UPLOAD_DIR = os.path.join(BASE_DIR, "uploads", "permanentFiles")
-                        file_path = os.path.join(UPLOAD_DIR, file_name)
-
-        if not os.path.exists(file_path):
-            raise HTTPException(status_code=404, detail="File not found at {file_path}")
-        
-        return FileResponse(
-            path=file_path,
+    def download_file(file_name: str, request: Request):
+        file_path = file_index.resolve(file_name)
+        if not file_path:
+            raise HTTPException(status_code=404, detail="File not found")
+
+        return file_response(
+            request.headers,
+            file_path,
             filename=file_name,
             media_type="application/octet-stream",
             headers={"Content-Disposition": f"attachment; filename={file_name}"}
@@ -62,135 +196,190 @@ def register_get_endpoints(app: FastAPI):
         return "Invalid verify token"
 
     @app.get("/api/chats")
-    async def get_chats_api():
+    async def get_chats_api(
+        after: str = Query(None),
+        limit: int = Query(CHATS_PAGE_SIZE, ge=1, le=CHATS_MAX_PAGE_SIZE)
+    ):
         try:
-            chats_cursor = db.chats.find().sort("timestamp", -1)
-            contacts_map = {c["waId"]: c for c in db.contacts.find()}
-
-            response_chats = []
-            for chat_doc in chats_cursor:
-                wa_id = chat_doc.get("waId")
-                if not wa_id:
-                    continue
-                is_group = chat_doc.get("isGroup", False)
-                chat_name = "Unknown"
-                chat_picture = None
-                participants_list = []
-
-                if is_group:
-                    chat_name = chat_doc.get("groupName", "Group Chat")
-                    chat_picture = chat_doc.get("groupPicture")
-                    raw_participants = chat_doc.get("participants", [])
-                    for p_raw in raw_participants:
-                        p_contact = contacts_map.get(p_raw["waId"])
-                        participants_list.append({
-                            "waId": p_raw["waId"],
-                            "name": p_contact.get("name") if p_contact else p_raw.get("name", p_raw["waId"]),
-                            "isAdmin": p_raw.get("isAdmin", True)
-                        })
-
-                else:
-                    contact = contacts_map.get(wa_id)
-                    if contact:
-                        chat_name = contact.get("name", "Unknown Contact")
-                        chat_picture = contact.get("profilePic")
-                    else:
-                        chat_name = wa_id
-
-                timestamp_raw = chat_doc.get("timestamp", datetime.utcnow())
-                if isinstance(timestamp_raw, datetime):
-                    timestamp_dt = timestamp_raw
-
-                elif isinstance(timestamp_raw, dict) and "$date" in timestamp_raw:
-                    try:
-                        timestamp_dt = datetime.fromisoformat(timestamp_raw["$date"].replace("Z", "+00:00"))
-                    except Exception:
-                        timestamp_dt = datetime.utcnow()  # fallback if parsing fails
-
-                elif isinstance(timestamp_raw, str):
-                    try:
-                        timestamp_dt = datetime.fromisoformat(timestamp_raw.replace("Z", "+00:00"))
-                    except Exception:
-                        timestamp_dt = datetime.utcnow()  # fallback if parsing fails
-
-                else:
-                    timestamp_dt = datetime.utcnow()  # final fallback
-
-                response_chats.append({
-                    "id": wa_id,
-                    "name": chat_name,
-                    "picture": chat_picture,
-                    "lastMessage": chat_doc.get("lastMessage", ""),
-                    "timestamp": timestamp_dt.timestamp() * 1000,
-                    "unreadCount": chat_doc.get("unreadCount", 0),
-                    "isTyping": chat_doc.get("isTyping", False),
-                    "isGroup": is_group,
-                    "participants": participants_list if is_group else [],
-                    "isPinned": chat_doc.get("isPinned", False),
-                    "isMuted": chat_doc.get("isMuted", False),
-                    "isBlocked": chat_doc.get("isBlocked", False)
-                })
-            return response_chats
-
+            # Read before the list so anything written meanwhile shows up in /api/chats/changes;
+            # the safe version is below any write still in flight, so none can be skipped
+            version = await safe_chat_version()
+
+            match = {"waId": {"$ne": None}}
+            if after:
+                match = {"$and": [match, chat_page_match(decode_cursor(after))]}
+
+            # Page first, then join contacts only for the chats on this page
+            pipeline = [
+                {"$match": match},
+                {"$sort": {"isPinned": -1, "timestamp": -1, "_id": -1}},
+                {"$limit": limit + 1},
+                *CHAT_LOOKUP_STAGES
+            ]
+            page = await db.chats.aggregate(pipeline).to_list(length=limit + 1)
+
+            next_cursor = None
+            if len(page) > limit:
+                page = page[:limit]
+                last = page[-1]
+                next_cursor = encode_cursor({"p": last.get("isPinned"), "t": last.get("timestamp"), "id": last["_id"]})
+
+            return {"chats": [format_chat(chat_doc) for chat_doc in page], "nextCursor": next_cursor, "version": version}
+
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"Error in /api/chats: {e}")
             import traceback
             traceback.print_exc()
             raise HTTPException(status_code=500, detail="Internal Server Error")
 
+    @app.get("/api/chats/changes")
+    async def get_chat_changes(
+        since: int = Query(0, ge=0),
+        limit: int = Query(CHATS_MAX_PAGE_SIZE, ge=1, le=CHATS_MAX_PAGE_SIZE)
+    ):
+        # Chats written after ?since=<version>, oldest change first; pass the
+        # returned version back as since (again right away while hasMore is true).
+        # Versions past the safe one may still have earlier writes in flight, so
+        # they wait for the next poll.
+        safe = await safe_chat_version()
+        pipeline = [
+            {"$match": {"version": {"$gt": since, "$lte": safe}, "waId": {"$ne": None}}},
+            {"$sort": {"version": 1}},
+            {"$limit": limit + 1},
+            *CHAT_LOOKUP_STAGES
+        ]
+        page = await db.chats.aggregate(pipeline).to_list(length=limit + 1)
+
+        has_more = len(page) > limit
+        page = page[:limit]
+        return {
+            "chats": [format_chat(chat_doc) for chat_doc in page],
+            "version": page[-1]["version"] if has_more else max(since, safe),
+            "hasMore": has_more
+        }
+
     from datetime import datetime
 
     @app.get("/api/messages/{chat_id}")
-    async def get_messages(chat_id: str):
-        messages_cursor = db.messages.find({"chatWaId": chat_id})
+    async def get_messages(
+        chat_id: str,
+        before: str = Query(None),
+        limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_MAX_PAGE_SIZE)
+    ):
+        query = {"chatWaId": chat_id}
+        if before:
+            cursor = decode_cursor(before)
+            query["$or"] = [
+                {"timestamp": {"$lt": cursor["t"]}},
+                {"timestamp": cursor["t"], "_id": {"$lt": cursor["id"]}}
+            ]
+
+        # Newest first on (chatWaId, timestamp, _id); one extra doc tells us if there is another page
+        messages_cursor = (
+            db.messages.find(query, MESSAGE_LIST_PROJECTION)
+            .sort([("timestamp", -1), ("_id", -1)])
+            .limit(limit + 1)
+        )
+        page = await messages_cursor.to_list(length=limit + 1)
 
-        messages = []
-        for msg in messages_cursor:
-            # Fix timestamp parsing
-            timestamp_raw = msg.get("timestamp", datetime.utcnow())
-            if isinstance(timestamp_raw, datetime):
-                timestamp_dt = timestamp_raw
-
-            elif isinstance(timestamp_raw, dict) and "$date" in timestamp_raw:
-                try:
-                    timestamp_dt = datetime.fromisoformat(timestamp_raw["$date"].replace("Z", "+00:00"))
-                except Exception:
-                    timestamp_dt = datetime.utcnow()  # fallback if parsing fails
-
-            elif isinstance(timestamp_raw, str):
-                try:
-                    timestamp_dt = datetime.fromisoformat(timestamp_raw.replace("Z", "+00:00"))
-                except Exception:
-                    timestamp_dt = datetime.utcnow()  # fallback if parsing fails
-
-            else:
-                timestamp_dt = datetime.utcnow()  # final fallback
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor({"t": page[-1].get("timestamp"), "id": page[-1]["_id"]})
 
+        messages = []
+        # Return the page oldest -> newest so the client can render it as-is
+        for msg in reversed(page):
             messages.append({
                 "id": str(msg["_id"]),
                 "chatId": msg["chatWaId"],
                 "senderId": msg["sender"],
                 "content": msg.get("content"),
-                "timestamp": int(timestamp_dt.timestamp() * 1000),
+                "timestamp": to_millis(msg["timestamp"]),
                 "status": msg["status"],
                 "file": msg.get("file"),
                 "fileName": msg.get("fileName"),
+                "fileStatus": msg.get("fileStatus"),
                 "referencedContent": msg.get("referenceContent"),
-                "reactions": msg.get("reactions", [])
+                "reactions": msg.get("reactions", []),
+                "media": msg.get("media"),
+                "thumbnail": msg.get("thumbnail")
             })
 
-        db.chats.update_one(
-            {"waId": chat_id},
-            {"$set": {"unreadCount": 0}}
-        )
-        return messages
+        if not before:
+            # Only a real reset is a change; opening an already-read chat writes nothing
+            reset = await db.chats.update_one(
+                {"waId": chat_id, "unreadCount": {"$ne": 0}},
+                {"$set": {"unreadCount": 0}}
+            )
+            if reset.modified_count:
+                await bump_chat_version(chat_id)
+        return {"messages": messages, "nextCursor": next_cursor}
+
+
+
+    @app.get("/api/search")
+    async def search_api(
+        q: str = Query(..., min_length=1, max_length=200),
+        chatId: str = Query(None),
+        after: str = Query(None),
+        limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE)
+    ):
+        # ?chatId= limits the search to one chat; ?after= is the nextCursor of the previous page
+        cursor = decode_cursor(after) if after else None
+        page, next_key = await search_messages(db.messages, q, chat_id=chatId, cursor=cursor, limit=limit)
+
+        terms = search_terms(q)
+        results = []
+        for msg in page:
+            snippet, highlights = make_snippet(msg.get("content"), terms)
+            if not highlights and msg.get("fileName"):
+                snippet, highlights = make_snippet(msg["fileName"], terms)
+            results.append({
+                "id": str(msg["_id"]),
+                "chatId": msg["chatWaId"],
+                "senderId": msg["sender"],
+                "content": msg.get("content"),
+                "timestamp": to_millis(msg["timestamp"]),
+                "status": msg.get("status"),
+                "file": msg.get("file"),
+                "fileName": msg.get("fileName"),
+                "thumbnail": msg.get("thumbnail"),
+                "score": msg["score"],
+                "snippet": snippet,
+                "highlights": highlights
+            })
+
+        return {"results": results, "nextCursor": encode_cursor(next_key) if next_key else None}
+
+    @app.get("/media/{file_hash}/thumb")
+    async def get_media_thumbnail(
+        file_hash: str,
+        w: int = Query(DEFAULT_THUMB_WIDTH, ge=1, le=4096)
+    ):
+        if len(file_hash) != 64 or any(c not in "0123456789abcdef" for c in file_hash):
+            raise HTTPException(status_code=400, detail="Invalid media hash")
 
+        path = await get_thumbnail(file_hash, snap_width(w))
+        if not path:
+            raise HTTPException(status_code=404, detail="No thumbnail for this media")
+
+        return FileResponse(
+            path=path,
+            media_type="image/jpeg",
+            headers={"Cache-Control": "public, max-age=31536000, immutable"}
+        )
 
+    @app.get("/api/media/cache/stats")
+    async def get_media_cache_stats():
+        return cache_stats()
 
     @app.get("/api/contacts")
     async def get_contacts():
         try:
-            contact_docs = list(db.contacts.find())
+            contact_docs = await db.contacts.find().to_list(length=None)
             contacts = []
 
             for c in contact_docs:
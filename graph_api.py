@@ -0,0 +1,173 @@
+# graph_api.py
+#
+# One shared async HTTP client for the WhatsApp Cloud (Graph) API:
+# keep-alive pooling (HTTP/2 when the h2 package is installed), timeouts,
+# exponential backoff on 429/5xx that honors Retry-After, and a token
+# bucket so we stay inside the account's throughput tier.
+#
+# The bucket lives in each process. GRAPH_RATE_LIMIT is the account-wide
+# rate and is split evenly over WEB_CONCURRENCY processes (the variable
+# uvicorn reads for its default --workers), so run with e.g.
+# WEB_CONCURRENCY=4 uvicorn main:app rather than --workers 4 alone.
+#
+# Every knob is a constructor argument, so the client can be pointed at
+# a local stub server (see benchmarks/graph_client_stub.py).
+
+import asyncio
+import importlib.util
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+GRAPH_API_BASE = os.getenv("GRAPH_API_BASE", "https://graph.facebook.com/v19.0")
+# Cloud API default tier is 80 messages/second; higher tiers allow up to 1000
+GRAPH_RATE_LIMIT = float(os.getenv("GRAPH_RATE_LIMIT", "80"))
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "5"))
+GRAPH_TIMEOUT = float(os.getenv("GRAPH_TIMEOUT", "30"))
+GRAPH_MAX_CONNECTIONS = int(os.getenv("GRAPH_MAX_CONNECTIONS", "20"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def retry_after_seconds(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def rewind_files(kwargs):
+    # Multipart uploads stream from open files; a retry must start them from the top
+    for value in (kwargs.get("files") or {}).values():
+        file_obj = value[1] if isinstance(value, tuple) else value
+        if hasattr(file_obj, "seek"):
+            file_obj.seek(0)
+
+
+class GraphClient:
+    def __init__(
+        self,
+        base_url=GRAPH_API_BASE,
+        rate=GRAPH_RATE_LIMIT / WEB_CONCURRENCY,
+        max_retries=GRAPH_MAX_RETRIES,
+        timeout=GRAPH_TIMEOUT,
+        max_connections=GRAPH_MAX_CONNECTIONS,
+        backoff_base=0.5,
+        backoff_max=30.0,
+        transport=None
+    ):
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.transport = transport
+        self.bucket = TokenBucket(rate) if rate else None
+        self.client = None
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "failures": 0}
+
+    def get_client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                http2=importlib.util.find_spec("h2") is not None,
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+                transport=self.transport
+            )
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def backoff(self, attempt):
+        # Full jitter: sleep anywhere up to base * 2^attempt
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def request(self, method, url, **kwargs):
+        client = self.get_client()
+        attempt = 0
+        while True:
+            if self.bucket:
+                await self.bucket.acquire()
+
+            self.stats["requests"] += 1
+            try:
+                response = await client.request(method, url, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # The request never left, so it is safe to retry even for POSTs
+                if attempt >= self.max_retries:
+                    self.stats["failures"] += 1
+                    raise
+                delay = self.backoff(attempt)
+                print(f"⚠️ Graph API connection failed ({e}), retrying in {delay:.1f}s")
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    if response.status_code >= 400:
+                        self.stats["failures"] += 1
+                    return response
+
+                if response.status_code == 429:
+                    self.stats["throttled"] += 1
+                retry_after = retry_after_seconds(response)
+                # Never let the server park a send (and its outbox lease) for hours
+                delay = min(retry_after, self.backoff_max) if retry_after is not None else self.backoff(attempt)
+                print(f"⚠️ Graph API {response.status_code}, retrying in {delay:.1f}s")
+
+            self.stats["retries"] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+            rewind_files(kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        # Streaming bodies can't be replayed, so these are rate limited but not retried
+        if self.bucket:
+            await self.bucket.acquire()
+        self.stats["requests"] += 1
+        async with self.get_client().stream(method, url, **kwargs) as response:
+            yield response
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+
+graph = GraphClient()
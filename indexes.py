@@ -0,0 +1,148 @@
+# indexes.py
+#
+# Declares the indexes the routes rely on, creates them at startup and
+# reports missing/unused ones. Run it directly to inspect query plans:
+#
+#   python indexes.py            # create + report
+#   python indexes.py explain    # print explain() for every query shape
+
+import asyncio
+import json
+import sys
+
+from pymongo import ASCENDING, DESCENDING, TEXT
+from pymongo.errors import OperationFailure
+
+from db import db
+
+
+# collection -> list of (name, keys, options)
+INDEXES = {
+    "chats": [
+        ("waId_unique", [("waId", ASCENDING)], {"unique": True}),
+        ("chat_list", [("isPinned", DESCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], {}),
+        ("version", [("version", ASCENDING)], {}),
+    ],
+    "contacts": [
+        ("waId_unique", [("waId", ASCENDING)], {"unique": True}),
+    ],
+    "messages": [
+        ("chat_timeline", [("chatWaId", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], {}),
+        ("wabaMessageId", [("wabaMessageId", ASCENDING)], {"sparse": True}),
+        # Storage GC rewrites/evicts messages by file URL
+        ("file", [("file", ASCENDING)], {}),
+        # Only one text index per collection; "none" skips stemming so mixed languages match literally
+        ("content_text", [("content", TEXT), ("fileName", TEXT)], {
+            "weights": {"content": 10, "fileName": 5},
+            "default_language": "none",
+            "language_override": "textLanguage"
+        }),
+    ],
+    "media_jobs": [
+        ("status", [("status", ASCENDING)], {}),
+    ],
+    "whatsapp_media": [
+        ("expiresAt_ttl", [("expiresAt", ASCENDING)], {"expireAfterSeconds": 0}),
+    ],
+    "webhook_inbox": [
+        ("status_leaseUntil", [("status", ASCENDING), ("leaseUntil", ASCENDING)], {}),
+        # Processed bodies are kept a week for debugging
+        ("processedAt_ttl", [("processedAt", ASCENDING)], {"expireAfterSeconds": 7 * 86400}),
+    ],
+    "outbox": [
+        ("status_createdAt", [("status", ASCENDING), ("createdAt", ASCENDING), ("_id", ASCENDING)], {}),
+        # release_waiting_message / cancel_waiting_message
+        ("messageId", [("messageId", ASCENDING)], {}),
+    ],
+}
+
+# Query shapes used by the routes: (description, collection, filter, sort)
+QUERY_SHAPES = [
+    ("chat by waId", "chats", {"waId": "34600000000"}, None),
+    ("chat list", "chats", {"waId": {"$ne": None}}, [("isPinned", DESCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("chat changes", "chats", {"version": {"$gt": 0}, "waId": {"$ne": None}}, [("version", ASCENDING)]),
+    ("contact by waId", "contacts", {"waId": "34600000000"}, None),
+    ("message page", "messages", {"chatWaId": "34600000000"}, [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("message by _id", "messages", {"_id": "00000000-0000-0000-0000-000000000000"}, None),
+    ("message by wabaMessageId", "messages", {"wabaMessageId": "wamid.x"}, None),
+    ("messages by file", "messages", {"file": {"$in": ["https://example.com/uploads/temporalFiles/images/x.jpg"]}}, None),
+    ("message search", "messages", {"$text": {"$search": "factura"}, "chatWaId": "34600000000"}, None),
+]
+
+
+async def ensure_indexes():
+    # create_index is a no-op when an identical index already exists
+    for collection, specs in INDEXES.items():
+        for name, keys, options in specs:
+            try:
+                await db[collection].create_index(keys, name=name, **options)
+            except OperationFailure as e:
+                print(f"❌ Could not create index {collection}.{name}: {e}")
+
+
+async def verify_indexes():
+    report = {"missing": [], "unused": [], "undeclared": []}
+
+    for collection, specs in INDEXES.items():
+        existing = await db[collection].index_information()
+        declared = {name for name, _, _ in specs}
+
+        for name in declared:
+            if name not in existing:
+                report["missing"].append(f"{collection}.{name}")
+
+        for name in existing:
+            if name != "_id_" and name not in declared:
+                report["undeclared"].append(f"{collection}.{name}")
+
+        try:
+            async for stat in db[collection].aggregate([{"$indexStats": {}}]):
+                if stat["name"] != "_id_" and stat.get("accesses", {}).get("ops", 0) == 0:
+                    report["unused"].append(f"{collection}.{stat['name']}")
+        except OperationFailure as e:
+            print(f"⚠️ $indexStats not available for {collection}: {e}")
+
+    for kind, names in report.items():
+        for name in names:
+            print(f"⚠️ Index {kind}: {name}")
+
+    return report
+
+
+def summarize_plan(plan):
+    # Walk the winning plan down to its leaf stages (IXSCAN / COLLSCAN / IDHACK ...)
+    stages = []
+    while plan:
+        stage = plan.get("stage")
+        if plan.get("indexName"):
+            stage = f"{stage}({plan['indexName']})"
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " <- ".join(s for s in stages if s)
+
+
+async def explain_query_shapes():
+    for description, collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+        planner = explanation.get("queryPlanner", {})
+        print(f"\n🔎 {description} ({collection})")
+        print(f"   filter: {json.dumps(query)}  sort: {sort}")
+        print(f"   plan:   {summarize_plan(planner.get('winningPlan', {}))}")
+
+
+async def main(args):
+    if args and args[0] == "explain":
+        await explain_query_shapes()
+        return
+
+    await ensure_indexes()
+    report = await verify_indexes()
+    if not any(report.values()):
+        print("✅ All indexes present and in use")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
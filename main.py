@@ -1,6 +1,5 @@
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
-from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -9,17 +8,25 @@ from pydantic import BaseModel
 
 from get_endpoints import register_get_endpoints
 from post_endpoints import register_post_endpoints
-from whatsapp_api import register_whatsapp_endpoints
+from whatsapp_api import register_whatsapp_endpoints, resume_inbound_media, start_webhook_retrier, stop_webhook_retrier
 from sse import push_to_clients
+from indexes import ensure_indexes, verify_indexes
+from media_jobs import start_media_jobs, stop_media_jobs
+from graph_api import graph
+from functions import media_upload_stats, chat_version
+from outbox import start_outbox, stop_outbox, outbox_metrics
+from file_server import file_index, UploadFiles
+import storage_gc
 
 #imports for force
 
 from datetime import datetime
 from db import db
+from pymongo import ReturnDocument
 import uuid
 import asyncio
 
-from sse import connected_clients
+from sse import broker
 
 load_dotenv()
 app = FastAPI()
@@ -37,10 +44,105 @@ register_post_endpoints(app)
 register_whatsapp_endpoints(app)
 
 
+@app.on_event("startup")
+async def bootstrap_indexes():
+    await ensure_indexes()
+    await verify_indexes()
+
+
+@app.on_event("startup")
+async def build_file_index():
+    await asyncio.to_thread(file_index.build)
+
+
+@app.on_event("startup")
+async def start_backplane():
+    await broker.backplane.start()
+
+
+@app.on_event("shutdown")
+async def stop_backplane():
+    await broker.backplane.stop()
+
+
+@app.on_event("startup")
+async def start_media_pool():
+    await start_media_jobs()
+
+
+@app.on_event("shutdown")
+async def stop_media_pool():
+    await stop_media_jobs()
+
+
+@app.on_event("shutdown")
+async def close_graph_client():
+    await graph.close()
+
+
+@app.on_event("startup")
+async def resume_media_downloads():
+    await resume_inbound_media()
+
+
+@app.on_event("startup")
+async def start_webhook_retries():
+    await start_webhook_retrier()
+
+
+@app.on_event("shutdown")
+async def stop_webhook_retries():
+    await stop_webhook_retrier()
+
+
+@app.on_event("startup")
+async def start_outbox_dispatcher():
+    await start_outbox()
+
+
+@app.on_event("shutdown")
+async def stop_outbox_dispatcher():
+    await stop_outbox()
+
+
+@app.on_event("startup")
+async def start_storage_collector():
+    await storage_gc.start_storage_gc()
+
+
+@app.on_event("shutdown")
+async def stop_storage_collector():
+    await storage_gc.stop_storage_gc()
+
+
+@app.get("/api/storage/gc")
+async def get_storage_gc(dryRun: bool = False):
+    # ?dryRun=true reports what a collection would do right now
+    if dryRun:
+        return await storage_gc.run_gc(dry_run=True)
+    return storage_gc.last_report or {"status": "not run yet"}
+
+
+@app.get("/api/outbox/metrics")
+async def get_outbox_metrics():
+    return await outbox_metrics()
+
+
+@app.get("/api/graph/metrics")
+async def graph_metrics():
+    return {**graph.stats, "mediaUploads": media_upload_stats}
+
+
 @app.get("/sse")
-async def sse_endpoint(request: Request):
-    queue = asyncio.Queue()
-    connected_clients.append(queue)
+async def sse_endpoint(request: Request, chats: str = None, lastEventId: str = None):
+    # ?chats=waId1,waId2 limits the stream to those chats
+    # Browsers send Last-Event-ID on reconnect; ?lastEventId= covers a fresh EventSource
+    last_event_id = request.headers.get("last-event-id") or lastEventId
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = 0  # unknown position, forces a resync
+    subscriber = broker.subscribe(chats.split(",") if chats else None, last_event_id)
 
     async def event_stream():
         print("event_streaming")
@@ -48,37 +150,48 @@ async def sse_endpoint(request: Request):
             #yield "retry: 10000\n\n"
             while True:
                 try:
-                    data = await asyncio.wait_for(queue.get(), timeout=25)
-                    yield f"data: {data}\n\n"
+                    data = await asyncio.wait_for(subscriber.queue.get(), timeout=25)
                 except asyncio.TimeoutError:
                     # 🔁 Send heartbeat to keep connection alive
                     yield ": ping\n\n"
+                    continue
+                if data is None:
+                    print("🐢 Slow client dropped by broker")
+                    break
+                yield data
         except asyncio.CancelledError:
             print("💤 Client disconnected")
         finally:
-            connected_clients.remove(queue)
+            broker.unsubscribe(subscriber)
 
     return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
+@app.get("/api/sse/metrics")
+async def sse_metrics():
+    return broker.metrics()
+
+
 @app.get("/api/forcenewcontact")
-def save_contact_file():
+async def save_contact_file():
     contact_doc = {
-        "_id": f"{uuid.uuid4().hex}",
-        "waId": "521234567891",
         "name": "Ron Reymon",
         "profilePic": "https://example.com/pic.jpg",
         "isOnline": True,
         "lastSeen": datetime.utcnow()
     }
-    db.contacts.insert_one(contact_doc)
+    # Fixed waId so /api/forcenewmessage has someone to talk to; upsert since waId is unique
+    contact_doc = await db.contacts.find_one_and_update(
+        {"waId": "521234567891"},
+        {"$set": contact_doc, "$setOnInsert": {"_id": f"{uuid.uuid4().hex}"}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
     return {"status": "inserted", "contact": contact_doc}
 
 @app.get("/api/forcenewchat")
-def save_chat_file():
+async def save_chat_file():
     chat_doc = {
-        "_id": f"{uuid.uuid4().hex}",
-        "waId": "521234567892",
         "isGroup": True,
         "groupName": "New group",
         "lastMessage": "",
@@ -87,11 +200,18 @@ def save_chat_file():
         "unreadCount": 0,
         "isTyping": False
     }
-    db.chats.insert_one(chat_doc)
+    # Same fixed waId every call (see /api/forcenewmessage); reset it instead of a duplicate key
+    async with chat_version() as version:
+        chat_doc = await db.chats.find_one_and_update(
+            {"waId": "521234567892"},
+            {"$set": {**chat_doc, "version": version}, "$setOnInsert": {"_id": f"{uuid.uuid4().hex}"}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
     return {"status": "inserted", "chat": chat_doc}
 
 @app.get("/api/forcenewmessage")
-def save_message_file():
+async def save_message_file():
     message_doc = {
         "_id": f"{uuid.uuid4().hex}",
         "chatWaId": "521234567892",
@@ -100,7 +220,8 @@ def save_message_file():
         "timestamp": datetime.utcnow(),
         "status": "sent"
     }
-    db.messages.insert_one(message_doc)
+    await db.messages.insert_one(message_doc)
+    broker.publish(message_doc, chat_id=message_doc["chatWaId"])
     return {"status": "inserted", "message": message_doc}
 
 
@@ -108,4 +229,4 @@ def save_message_file():
 
 
 
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+app.mount("/uploads", UploadFiles(directory="uploads"), name="uploads")
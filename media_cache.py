@@ -0,0 +1,73 @@
+# media_cache.py
+#
+# Content-addressed index of processed uploads: sha256 of the original
+# bytes -> final artifact (category + file name under temporalFiles).
+# A repeat upload of the same bytes resolves here without ffprobe,
+# ffmpeg or Pillow.
+
+import os
+from datetime import datetime
+
+from db import db
+from functions import PUBLIC_BASE_URL, public_file_url
+from file_server import file_index, precompress_in_background
+
+BASE_TEMP_DIR = os.path.join("uploads", "temporalFiles")
+PERMANENT_DIR = os.path.join("uploads", "permanentFiles")
+
+stats = {"hits": 0, "misses": 0, "stale": 0}
+
+
+def artifact_path(entry):
+    # Promoted artifacts (see storage_gc) live flat in permanentFiles
+    if entry.get("permanent"):
+        return os.path.join(PERMANENT_DIR, entry["uniqueName"])
+    return os.path.join(BASE_TEMP_DIR, entry["category"], entry["uniqueName"])
+
+
+def artifact_url(entry):
+    if entry.get("permanent"):
+        return f"{PUBLIC_BASE_URL}/uploads/permanentFiles/{entry['uniqueName']}"
+    return public_file_url(entry["category"], entry["uniqueName"])
+
+
+async def lookup_media(file_hash):
+    entry = await db.media_cache.find_one({"_id": file_hash})
+
+    if entry and os.path.exists(artifact_path(entry)):
+        stats["hits"] += 1
+        await db.media_cache.update_one(
+            {"_id": file_hash},
+            {"$inc": {"hits": 1}, "$set": {"lastHitAt": datetime.utcnow()}}
+        )
+        return entry
+
+    if entry:
+        # The artifact was removed from disk; forget it and process again
+        stats["stale"] += 1
+        file_index.remove(artifact_path(entry))
+        await db.media_cache.delete_one({"_id": file_hash})
+
+    stats["misses"] += 1
+    return None
+
+
+async def remember_media(file_hash, category, unique_name, media=None):
+    # Every finished artifact passes through here, so /download sees it at once
+    path = os.path.join(BASE_TEMP_DIR, category, unique_name)
+    file_index.add(path)
+    precompress_in_background(path)
+    now = datetime.utcnow()
+    await db.media_cache.update_one(
+        {"_id": file_hash},
+        {
+            "$set": {"category": category, "uniqueName": unique_name, "media": media, "updatedAt": now, "permanent": False},
+            "$setOnInsert": {"createdAt": now, "hits": 0}
+        },
+        upsert=True
+    )
+
+
+def cache_stats():
+    lookups = stats["hits"] + stats["misses"]
+    return {**stats, "hitRate": stats["hits"] / lookups if lookups else 0.0}
@@ -0,0 +1,242 @@
+# media_jobs.py
+#
+# Video/audio transcoding runs here instead of inside POST /api/messages.
+# Jobs are persisted in db.media_jobs and executed in a process pool of
+# MEDIA_WORKERS processes. When a job finishes, the message gets its file,
+# an SSE "message_update" event goes out, and the WhatsApp send that was
+# queued "waiting" at POST time is released.
+# Media that already meets Cloud API limits is passed through or remuxed
+# instead of re-encoded.
+#
+# Every worker process runs this, so a job is claimed (owner + lease, renewed
+# while it transcodes) before it runs, and only its owner may finish it.
+
+import asyncio
+import os
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+from db import db
+from sse import broker
+from media_cache import remember_media
+from thumbnails import thumbnail_info
+from functions import (
+    convert_to_whatsapp_video,
+    convert_audio_to_ogg,
+    probe_media,
+    plan_media,
+    remux_media,
+    public_file_url,
+    media_type_for
+)
+from outbox import enqueue_whatsapp_message, release_waiting_message, cancel_waiting_message
+
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))
+BASE_TEMP_DIR = os.path.join("uploads", "temporalFiles")
+MEDIA_JOB_LEASE = timedelta(minutes=5)
+JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+executor = None
+job_tasks = set()
+
+
+def transcode_media(input_path, file_hash, ext, mime_type):
+    # Runs in a worker process: probe once, then passthrough, remux or transcode
+    probe = probe_media(input_path)
+    category, plan = plan_media(probe, ext)
+    print(f"🎞️ {input_path}: {plan} ({probe['videoCodec']}/{probe['audioCodec']}, {probe['size']} bytes)")
+
+    if category == "videos":
+        converted_name = f"{file_hash}.mp4"
+        container = "mp4"
+        converter = convert_to_whatsapp_video
+    else:
+        converted_name = f"{file_hash}.ogg"
+        container = "ogg"
+        converter = convert_audio_to_ogg
+
+    temp_dir = os.path.join(BASE_TEMP_DIR, category)
+    os.makedirs(temp_dir, exist_ok=True)
+    media = {
+        "plan": plan,
+        "duration": probe["duration"],
+        "width": probe["width"],
+        "height": probe["height"],
+        "videoCodec": probe["videoCodec"],
+        "audioCodec": probe["audioCodec"]
+    }
+
+    if plan == "passthrough":
+        os.replace(input_path, os.path.join(temp_dir, converted_name))
+        return {"category": category, "uniqueName": converted_name, "media": media}
+
+    # Per process, in case a lease ran out and another worker is on the same input
+    converted_path = os.path.join(temp_dir, f"{file_hash}_converting_{os.getpid()}.{container}")
+    if plan == "remux":
+        success = remux_media(input_path, converted_path, container)
+    else:
+        success = converter(input_path, converted_path)
+
+    if success and os.path.exists(converted_path):
+        os.replace(converted_path, os.path.join(temp_dir, converted_name))
+        os.remove(input_path)
+        return {"category": category, "uniqueName": converted_name, "media": media}
+
+    # Conversion failed: keep the original upload as-is
+    print("⚠️ Conversion failed, keeping original file")
+    if os.path.exists(converted_path):
+        os.remove(converted_path)
+    original_name = f"{file_hash}{ext}"
+    os.replace(input_path, os.path.join(temp_dir, original_name))
+    return {"category": category, "uniqueName": original_name, "media": {**media, "plan": "original"}}
+
+
+async def start_media_jobs():
+    global executor
+    executor = ProcessPoolExecutor(max_workers=MEDIA_WORKERS)
+
+    # Pick up jobs whose owner died; live siblings keep renewing theirs
+    now = datetime.utcnow()
+    async for job in db.media_jobs.find(
+        {"status": {"$in": ["queued", "running"]}, "$or": [{"leaseUntil": {"$exists": False}}, {"leaseUntil": {"$lt": now}}]},
+        {"_id": 1}
+    ):
+        print(f"🔁 Resuming media job {job['_id']}")
+        start_job(job["_id"])
+
+
+async def stop_media_jobs():
+    for task in list(job_tasks):
+        task.cancel()
+    if executor:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def start_job(job_id):
+    task = asyncio.create_task(run_media_job(job_id))
+    job_tasks.add(task)
+    task.add_done_callback(job_tasks.discard)
+
+
+async def claim_media_job(job_id):
+    # Atomic, so a job runs on one worker at a time
+    now = datetime.utcnow()
+    return await db.media_jobs.find_one_and_update(
+        {
+            "_id": job_id,
+            "status": {"$in": ["queued", "running"]},
+            "$or": [{"leaseUntil": {"$exists": False}}, {"leaseUntil": {"$lt": now}}]
+        },
+        {
+            "$set": {"status": "running", "owner": JOB_OWNER, "leaseUntil": now + MEDIA_JOB_LEASE, "updatedAt": now},
+            "$inc": {"attempts": 1}
+        },
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def renew_media_job(job_id):
+    while True:
+        await asyncio.sleep(MEDIA_JOB_LEASE.total_seconds() / 3)
+        await db.media_jobs.update_one(
+            {"_id": job_id, "owner": JOB_OWNER, "status": "running"},
+            {"$set": {"leaseUntil": datetime.utcnow() + MEDIA_JOB_LEASE}}
+        )
+
+
+async def enqueue_media_job(message_id, chat_id, input_path, file_hash, ext, mime_type, file_name):
+    now = datetime.utcnow()
+    job = {
+        "_id": message_id,
+        "messageId": message_id,
+        "chatWaId": chat_id,
+        "inputPath": input_path,
+        "fileHash": file_hash,
+        "ext": ext,
+        "mimeType": mime_type,
+        "fileName": file_name,
+        "status": "queued",
+        "attempts": 0,
+        "createdAt": now,
+        "updatedAt": now
+    }
+    await db.media_jobs.insert_one(job)
+    start_job(message_id)
+    return job
+
+
+async def run_media_job(job_id):
+    job = await claim_media_job(job_id)
+    if not job:
+        # Another worker holds it, or it already finished
+        return
+
+    loop = asyncio.get_running_loop()
+    renewer = asyncio.create_task(renew_media_job(job_id))
+    try:
+        result = await loop.run_in_executor(
+            executor, transcode_media, job["inputPath"], job["fileHash"], job["ext"], job["mimeType"]
+        )
+    except Exception as e:
+        print(f"❌ Media job {job['_id']} failed: {e}")
+        if await finish_media_job(job, "failed", error=str(e)):
+            await cancel_waiting_message(job["messageId"], str(e))
+        return
+    finally:
+        renewer.cancel()
+
+    await remember_media(job["fileHash"], result["category"], result["uniqueName"], result["media"])
+    file_url = public_file_url(result["category"], result["uniqueName"])
+    local_file_path = os.path.join(BASE_TEMP_DIR, result["category"], result["uniqueName"])
+    thumbnail = thumbnail_info(job["fileHash"], result["media"]) if result["category"] == "videos" else None
+    if not await finish_media_job(job, "done", file_url=file_url, result=result, media=result["media"], thumbnail=thumbnail):
+        return
+
+    send = {
+        "media_type": media_type_for(file_url),
+        "media_url": local_file_path,
+        "media_filename": job["fileName"],
+        "media_hash": job["fileHash"]
+    }
+    try:
+        # Normally the send is already queued, waiting for this file
+        if not await release_waiting_message(job["messageId"], **send):
+            await enqueue_whatsapp_message(to=job["chatWaId"], message_id=job["messageId"], **send)
+    except Exception as e:
+        print(f"❌ Failed to queue message for WhatsApp API: {e}")
+
+
+async def finish_media_job(job, status, file_url=None, result=None, error=None, media=None, thumbnail=None):
+    # Only the current owner finishes, and a done job is never turned back into a failure;
+    # returns False when this worker no longer owns the job
+    message_status = "sent" if status == "done" else "failed"
+
+    updated = await db.media_jobs.update_one(
+        {"_id": job["_id"], "owner": JOB_OWNER, "status": "running"},
+        {
+            "$set": {"status": status, "result": result, "error": error, "updatedAt": datetime.utcnow()},
+            "$unset": {"leaseUntil": ""}
+        }
+    )
+    if updated.matched_count == 0:
+        print(f"⚠️ Media job {job['_id']} was taken over by another worker, dropping this result")
+        return False
+    await db.messages.update_one(
+        {"_id": job["messageId"]},
+        {"$set": {"file": file_url, "status": message_status, "media": media, "thumbnail": thumbnail}}
+    )
+
+    broker.publish({
+        "type": "message_update",
+        "id": job["messageId"],
+        "chatId": job["chatWaId"],
+        "file": file_url,
+        "fileName": job["fileName"],
+        "media": media,
+        "thumbnail": thumbnail,
+        "status": message_status
+    }, chat_id=job["chatWaId"])
+    return True
@@ -0,0 +1,102 @@
+# migrate_timestamps.py
+#
+# Rewrites legacy timestamps ({"$date": ...} subdocuments and ISO strings)
+# in messages and chats as native BSON dates.
+#
+#   python migrate_timestamps.py                 # migrate both collections
+#   python migrate_timestamps.py --batch-size 2000 messages
+#
+# Every batch re-runs LEGACY_FILTER, which only matches documents not yet
+# migrated, so an interrupted run simply picks up where it stopped. (No
+# _id checkpoint: ids mix strings and ObjectIds, which don't share an order.)
+
+import argparse
+import asyncio
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from db import db
+
+MIGRATION_NAME = "timestamps_to_bson_dates"
+COLLECTIONS = ["messages", "chats"]
+LEGACY_FILTER = {"timestamp": {"$exists": True, "$not": {"$type": "date"}}}
+
+
+def parse_legacy_timestamp(value):
+    if isinstance(value, dict) and "$date" in value:
+        value = value["$date"]
+
+    if isinstance(value, datetime):
+        dt = value
+    elif isinstance(value, (int, float)):
+        dt = datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+    elif isinstance(value, str):
+        try:
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    else:
+        return None
+
+    # Store naive UTC, like datetime.utcnow() everywhere else
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def fallback_timestamp(doc_id):
+    # ObjectIds carry their insert time; uuid/wamid ids don't, so use now
+    if isinstance(doc_id, ObjectId):
+        return doc_id.generation_time.astimezone(timezone.utc).replace(tzinfo=None)
+    return datetime.utcnow()
+
+
+async def migrate_collection(name, batch_size):
+    migrated = skipped = 0
+    while True:
+        batch = await db[name].find(LEGACY_FILTER, {"timestamp": 1}).limit(batch_size).to_list(length=batch_size)
+        if not batch:
+            break
+
+        operations = []
+        for doc in batch:
+            dt = parse_legacy_timestamp(doc["timestamp"])
+            update = {"timestamp": dt}
+            if dt is None:
+                # Never leave a non-date behind: the read paths assume BSON dates
+                skipped += 1
+                dt = fallback_timestamp(doc["_id"])
+                update = {"timestamp": dt, "legacyTimestamp": doc["timestamp"]}
+                print(f"⚠️ {name}/{doc['_id']}: unparseable timestamp {doc['timestamp']!r}, using {dt.isoformat()}")
+            operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+
+        result = await db[name].bulk_write(operations, ordered=False)
+        migrated += result.modified_count
+        if result.modified_count == 0:
+            # Every document gets a date, so this only happens if writes are being lost
+            print(f"❌ {name}: batch made no progress, stopping")
+            return
+        print(f"🔁 {name}: {migrated} migrated, {skipped} defaulted")
+
+    await db.migrations.update_one(
+        {"_id": f"{MIGRATION_NAME}:{name}"},
+        {"$set": {"completedAt": datetime.utcnow()}, "$unset": {"lastId": ""}},
+        upsert=True
+    )
+    print(f"✅ {name}: done, {migrated} migrated, {skipped} defaulted")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("collections", nargs="*", choices=COLLECTIONS)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    for name in args.collections or COLLECTIONS:
+        await migrate_collection(name, args.batch_size)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,262 @@
+# outbox.py
+#
+# Durable outbox for WhatsApp sends. Request handlers only insert into
+# db.outbox; a background dispatcher drains it with bounded concurrency,
+# one message at a time per recipient so ordering is kept. Attempts and
+# the next retry time live on the document, so retries survive restarts.
+# On success the wabaMessageId is written back to the chat message.
+#
+# Media still being transcoded is queued "waiting" at POST time and released
+# when its job finishes, so it keeps its place in the recipient's order.
+# A worker renews its claim while it sends and only settles items it still
+# owns; errors Graph will never accept fail at once instead of blocking the
+# recipient's queue for hours.
+
+import asyncio
+import os
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+from db import db
+from sse import broker
+from functions import send_whatsapp_message, extract_waba_message_id, save_message_to_db, outgoing_content, media_id_rejected
+
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+OUTBOX_SCAN_LIMIT = 1000
+# A "sending" claim not renewed for this long belongs to a worker that died
+OUTBOX_LEASE = timedelta(minutes=5)
+# Items that still hold their recipient's place in line
+ACTIVE_STATUSES = ["waiting", "pending", "sending"]
+# Throttling Graph reports as a 4xx; everything else in 4xx won't succeed on retry
+THROTTLE_ERROR_CODES = {4, 80007, 130429, 131048, 131056}
+
+wakeup = asyncio.Event()
+in_flight = set()
+sent_times = deque()
+stats = {"sent": 0, "failed": 0, "retried": 0}
+dispatcher_task = None
+
+
+async def enqueue_whatsapp_message(to, message_id=None, auto_save=False, waiting=False, **payload):
+    # waiting=True holds the recipient's place until release_waiting_message()
+    if auto_save and not message_id:
+        # Save the chat message once, now; deliver() only fills in the outcome
+        message_id = await save_message_to_db(
+            to=to,
+            sender="me",
+            content=outgoing_content(**payload),
+            reference_id=payload.get("reply_to")
+        )
+
+    now = datetime.utcnow()
+    await db.outbox.insert_one({
+        "_id": uuid.uuid4().hex,
+        "to": to,
+        "messageId": message_id,
+        "payload": payload,
+        "status": "waiting" if waiting else "pending",
+        "attempts": 0,
+        "nextAttemptAt": now,
+        "createdAt": now
+    })
+    wakeup.set()
+
+
+async def release_waiting_message(message_id, **payload):
+    # The media is ready: fill in the payload and let the item go out in its turn.
+    # Returns False when nothing was waiting (jobs queued before waiting items existed).
+    result = await db.outbox.update_one(
+        {"messageId": message_id, "status": "waiting"},
+        {"$set": {"status": "pending", "payload": payload, "nextAttemptAt": datetime.utcnow()}}
+    )
+    wakeup.set()
+    return result.matched_count > 0
+
+
+async def cancel_waiting_message(message_id, error):
+    # The media never became ready; stop holding up the recipient's queue
+    await db.outbox.update_one(
+        {"messageId": message_id, "status": "waiting"},
+        {"$set": {"status": "failed", "lastError": error, "failedAt": datetime.utcnow()}}
+    )
+    wakeup.set()
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(3600, 5 * (2 ** (attempts - 1))))
+
+
+def permanent_error(response):
+    if response is None or not 400 <= response.status_code < 500 or response.status_code in (408, 429):
+        return False
+    if media_id_rejected(response):
+        # The cached media id was dropped; the retry uploads the file again
+        return False
+    try:
+        code = response.json().get("error", {}).get("code")
+    except Exception:
+        code = None
+    return code not in THROTTLE_ERROR_CODES
+
+
+async def renew_claim(item):
+    # Uploads plus Graph retries can outlast OUTBOX_LEASE; keep the claim alive
+    while True:
+        await asyncio.sleep(OUTBOX_LEASE.total_seconds() / 3)
+        await db.outbox.update_one(
+            {"_id": item["_id"], "status": "sending", "claimId": item["claimId"]},
+            {"$set": {"claimedAt": datetime.utcnow()}}
+        )
+
+
+async def deliver(item, semaphore):
+    # Settle only while the claim is still ours; if it was taken over, the new owner decides
+    own_claim = {"_id": item["_id"], "status": "sending", "claimId": item["claimId"]}
+    renewer = asyncio.create_task(renew_claim(item))
+    try:
+        try:
+            response = await send_whatsapp_message(to=item["to"], **item["payload"])
+            error = None if response is not None and response.status_code == 200 else (response.text if response is not None else "no response")
+        except Exception as e:
+            response, error = None, str(e)
+        renewer.cancel()
+
+        attempts = item["attempts"] + 1
+        now = datetime.utcnow()
+
+        if error is None:
+            waba_id = extract_waba_message_id(response)
+            settled = await db.outbox.update_one(
+                own_claim,
+                {"$set": {"status": "sent", "attempts": attempts, "sentAt": now, "wabaMessageId": waba_id}}
+            )
+            if settled.matched_count == 0:
+                print(f"⚠️ Outbox item {item['_id']} was sent after its claim was taken over")
+            if item.get("messageId") and waba_id:
+                await db.messages.update_one({"_id": item["messageId"]}, {"$set": {"wabaMessageId": waba_id}})
+            stats["sent"] += 1
+            sent_times.append(time.monotonic())
+            return
+
+        if attempts >= OUTBOX_MAX_ATTEMPTS or permanent_error(response):
+            print(f"❌ Giving up on outbox item {item['_id']} to {item['to']}: {error}")
+            settled = await db.outbox.update_one(
+                own_claim,
+                {"$set": {"status": "failed", "attempts": attempts, "lastError": error, "failedAt": now}}
+            )
+            if settled.matched_count == 0:
+                return
+            stats["failed"] += 1
+            if item.get("messageId"):
+                await db.messages.update_one({"_id": item["messageId"]}, {"$set": {"status": "failed"}})
+                broker.publish({
+                    "type": "message_update",
+                    "id": item["messageId"],
+                    "chatId": item["to"],
+                    "status": "failed"
+                }, chat_id=item["to"])
+            return
+
+        print(f"⚠️ Outbox send to {item['to']} failed (attempt {attempts}), retrying: {error}")
+        await db.outbox.update_one(
+            own_claim,
+            {"$set": {
+                "status": "pending",
+                "attempts": attempts,
+                "lastError": error,
+                "nextAttemptAt": now + retry_delay(attempts)
+            }}
+        )
+        stats["retried"] += 1
+
+    finally:
+        renewer.cancel()
+        in_flight.discard(item["to"])
+        semaphore.release()
+        wakeup.set()
+
+
+async def dispatch_once(semaphore):
+    now = datetime.utcnow()
+
+    await db.outbox.update_many(
+        {"status": "sending", "claimedAt": {"$lt": now - OUTBOX_LEASE}},
+        {"$set": {"status": "pending"}}
+    )
+
+    # The oldest unsent item per recipient is the only one that may go out; group
+    # first so one recipient's backlog can't push everyone else out of the scan
+    pipeline = [
+        {"$match": {"status": {"$in": ACTIVE_STATUSES}}},
+        {"$sort": {"createdAt": 1, "_id": 1}},
+        {"$group": {"_id": "$to", "head": {"$first": "$$ROOT"}}},
+        {"$replaceRoot": {"newRoot": "$head"}},
+        {"$match": {"status": "pending", "nextAttemptAt": {"$lte": now}, "to": {"$nin": list(in_flight)}}},
+        {"$sort": {"createdAt": 1, "_id": 1}},
+        {"$limit": OUTBOX_SCAN_LIMIT}
+    ]
+    async for item in db.outbox.aggregate(pipeline, allowDiskUse=True):
+        recipient = item["to"]
+        if recipient in in_flight:
+            continue
+
+        claimed = await db.outbox.find_one_and_update(
+            {"_id": item["_id"], "status": "pending"},
+            {"$set": {"status": "sending", "claimedAt": now, "claimId": uuid.uuid4().hex}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not claimed:
+            continue
+
+        await semaphore.acquire()
+        in_flight.add(recipient)
+        asyncio.create_task(deliver(claimed, semaphore))
+
+
+async def run_dispatcher():
+    semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    while True:
+        wakeup.clear()
+        try:
+            await dispatch_once(semaphore)
+        except Exception as e:
+            print(f"❌ Outbox dispatcher error: {e}")
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def start_outbox():
+    global dispatcher_task
+    dispatcher_task = asyncio.create_task(run_dispatcher())
+
+
+async def stop_outbox():
+    if dispatcher_task:
+        dispatcher_task.cancel()
+
+
+async def outbox_metrics():
+    cutoff = time.monotonic() - 60
+    while sent_times and sent_times[0] < cutoff:
+        sent_times.popleft()
+
+    oldest = await db.outbox.find_one({"status": "pending"}, sort=[("createdAt", 1)])
+    lag = (datetime.utcnow() - oldest["createdAt"]).total_seconds() if oldest else 0.0
+
+    return {
+        **stats,
+        "pending": await db.outbox.count_documents({"status": "pending"}),
+        "waiting": await db.outbox.count_documents({"status": "waiting"}),
+        "inFlight": len(in_flight),
+        "lagSeconds": lag,
+        "sentLastMinute": len(sent_times),
+        "throughputPerSecond": len(sent_times) / 60
+    }
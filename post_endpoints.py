@@ -1,15 +1,15 @@
 from fastapi import FastAPI, Form, File, UploadFile, HTTPException, Body, Query, Path
-from datetime import datetime
+from datetime import datetime, timezone
 
-from functions import convert_to_whatsapp_video, convert_audio_to_ogg, send_whatsapp_message, sanitize_image
+from functions import sanitize_image_async, public_file_url, media_type_for, stream_upload, chat_version, bump_chat_version
+from media_jobs import enqueue_media_job
+from outbox import enqueue_whatsapp_message
+from media_cache import lookup_media, remember_media, artifact_path, artifact_url
+from thumbnails import image_dimensions, thumbnail_info
 from db import db
 
 
-import hashlib
 import os
-import magic
-import subprocess
-import json
 
 def register_post_endpoints(app: FastAPI):
     @app.post("/api/messages")
@@ -23,26 +23,10 @@ def register_post_endpoints(app: FastAPI):
         referenceContent: str = Form(None)
     ):
 
-        def is_audio_only_webm(file_path):
-            try:
-                result = subprocess.run(
-                    ["ffprobe", "-v", "error", "-show_streams", "-print_format", "json", file_path],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                streams = json.loads(result.stdout).get("streams", [])
-                video_streams = [s for s in streams if s.get("codec_type") == "video"]
-                audio_streams = [s for s in streams if s.get("codec_type") == "audio"]
-                return len(video_streams) == 0 and len(audio_streams) > 0
-            except Exception as e:
-                print(f"ffprobe error: {e}")
-                return False
-
         try:
             # Check if the messsage
             # Check if chat is blocked
-            chat = db.chats.find_one({"waId": chatId})
+            chat = await db.chats.find_one({"waId": chatId})
             if chat and chat.get("isBlocked") is True:
                 print(f"⚠️ Message to blocked chat {chatId} ignored.")
                 raise HTTPException(status_code=403, detail="This chat is blocked. Message not saved.")
@@ -50,168 +34,161 @@ def register_post_endpoints(app: FastAPI):
 
             file_url = None
             file_name = None
+            local_file_path = None
+            media_job = None
+            media = None
+            thumbnail = None
 
             if file:
-                file_bytes = await file.read()
-                print(f"Uploaded file size: {len(file_bytes)} bytes")
-                file_hash = hashlib.sha256(file_bytes).hexdigest()
-                mime_type = magic.from_buffer(file_bytes, mime=True)
-
-                print("MIMETYPE", mime_type)
-
                 # Prepare file paths
                 permanent_dir = os.path.join("uploads", "permanentFiles")
                 base_temp_dir = os.path.join("uploads", "temporalFiles")
+                pending_dir = os.path.join(base_temp_dir, "pending")
                 os.makedirs(permanent_dir, exist_ok=True)
-                os.makedirs(base_temp_dir, exist_ok=True)
+
+                # Stream the upload to disk; every later step renames this file in place
+                upload_path, file_hash, file_size, mime_type = await stream_upload(file, pending_dir)
+                print(f"Uploaded file size: {file_size} bytes")
+                print("MIMETYPE", mime_type)
 
                 # Use the hash and original extension for naming
                 ext = os.path.splitext(file.filename)[1]
                 unique_name = f"{file_hash}{ext}"
+                file_name = file.filename
 
                 # Check for existing file
                 permanent_path = os.path.join(permanent_dir, unique_name)
+                cached = None if os.path.exists(permanent_path) else await lookup_media(file_hash)
+
                 if os.path.exists(permanent_path):
+                    os.remove(upload_path)
                     file_url = f"https://bricopoxi.com/uploads/permanentFiles/{unique_name}"
-                else:
-                    # Temporarily save file for probe
-                    probe_temp_path = os.path.join(base_temp_dir, f"{file_hash}_probe{ext}")
-                    with open(probe_temp_path, "wb") as f:
-                        f.write(file_bytes)
-
-                    # Determine category
-                    if mime_type.startswith("image/"):
-                        category = "images"
-                        temp_dir = os.path.join(base_temp_dir, category)
-                        os.makedirs(temp_dir, exist_ok=True)
-
-                        sanitized_name = f"{file_hash}.jpg"
-                        sanitized_path = os.path.join(temp_dir, sanitized_name)
-
-                        success = sanitize_image(file_bytes, sanitized_path)
-
-                        if success:
-                            unique_name = sanitized_name
-                            temp_path = sanitized_path
-                        else:
-                            print("⚠️ Falling back to original image without sanitization.")
-                            fallback_path = os.path.join(temp_dir, unique_name)
-                            with open(fallback_path, "wb") as f:
-                                f.write(file_bytes)
-                            temp_path = fallback_path
-
-
-                    elif mime_type.startswith("video/"):
-                        if is_audio_only_webm(probe_temp_path):
-                            print("🎧 Detected audio-only file (video/webm with only audio stream)")
-                            category = "documents"
-                        else:
-                            category = "videos"
-                    elif mime_type.startswith("audio/"):
-                        category = "documents"
-                    else:
-                        category = "documents"
+                    local_file_path = permanent_path
+
+                elif cached:
+                    # Same bytes were processed before: reuse the artifact as-is
+                    print(f"♻️ Media cache hit for {file_hash}")
+                    os.remove(upload_path)
+                    file_url = artifact_url(cached)
+                    local_file_path = artifact_path(cached)
+                    media = cached.get("media")
+                    thumbnail = thumbnail_info(file_hash, media)
+
+                elif mime_type.startswith("image/"):
+                    temp_dir = os.path.join(base_temp_dir, "images")
+                    os.makedirs(temp_dir, exist_ok=True)
+
+                    sanitized_name = f"{file_hash}.jpg"
+                    sanitized_path = os.path.join(temp_dir, sanitized_name)
 
-                    os.remove(probe_temp_path)
+                    success = await sanitize_image_async(upload_path, sanitized_path)
+
+                    if success:
+                        unique_name = sanitized_name
+                        temp_path = sanitized_path
+                    else:
+                        print("⚠️ Falling back to original image without sanitization.")
+                        temp_path = os.path.join(temp_dir, unique_name)
+                        os.replace(upload_path, temp_path)
+
+                    media = image_dimensions(temp_path)
+                    thumbnail = thumbnail_info(file_hash, media)
+                    await remember_media(file_hash, "images", unique_name, media)
+                    file_url = public_file_url("images", unique_name)
+                    local_file_path = temp_path
+
+                elif mime_type.startswith(("video/", "audio/")):
+                    # Probing and transcoding happen in the media job pool; the
+                    # message is sent to WhatsApp once the file is ready
+                    media_job = {
+                        "input_path": upload_path,
+                        "file_hash": file_hash,
+                        "ext": ext,
+                        "mime_type": mime_type
+                    }
 
-                    temp_dir = os.path.join(base_temp_dir, category)
+                else:
+                    temp_dir = os.path.join(base_temp_dir, "documents")
                     os.makedirs(temp_dir, exist_ok=True)
 
                     temp_path = os.path.join(temp_dir, unique_name)
+                    if os.path.exists(temp_path):
+                        os.remove(upload_path)
+                    else:
+                        os.replace(upload_path, temp_path)
 
-                    # Save file if not already saved
-                    if not os.path.exists(temp_path):
-                        with open(temp_path, "wb") as f:
-                            f.write(file_bytes)
-
-                        # If it's a video, convert it
-                        if category == "videos":
-                            converted_path = os.path.join(temp_dir, f"{file_hash}_whatsapp.mp4")
-                            success = convert_to_whatsapp_video(temp_path, converted_path)
-
-                            if success and os.path.exists(converted_path):
-                                os.remove(temp_path)  # Remove original
-                                final_path = os.path.join(temp_dir, f"{file_hash}.mp4")
-                                os.replace(converted_path, final_path)
-                                temp_path = final_path
-                                unique_name = f"{file_hash}.mp4"
-
-                        # If it's audio, convert to .ogg
-                        elif mime_type.startswith("audio/") or (mime_type == "video/webm" and category == "documents"):
-                            print("AUDIO DETECTED")
-                            temp_path = os.path.join(temp_dir, f"{file_hash}{ext}")
-                            with open(temp_path, "wb") as f:
-                                f.write(file_bytes)
-
-                            final_name = f"{file_hash}.ogg"
-                            final_path = os.path.join(temp_dir, final_name)
-                            success = convert_audio_to_ogg(temp_path, final_path)
-
-                            if success:
-                                os.remove(temp_path)
-                                unique_name = final_name
-
-                    file_url = f"https://bricopoxi.com/uploads/temporalFiles/{category}/{unique_name}"
-                    local_file_path = os.path.join("uploads", "temporalFiles", category, unique_name)
-                    file_name = file.filename
+                    await remember_media(file_hash, "documents", unique_name)
+                    file_url = public_file_url("documents", unique_name)
+                    local_file_path = temp_path
 
             try:
-                ts = datetime.fromtimestamp(float(timestamp) / 1000)
+                ts = datetime.utcfromtimestamp(float(timestamp) / 1000)
             except Exception:
                 ts = datetime.utcnow()
 
+            status = "processing" if media_job else "sent"
+
             message_doc = {
                 "_id": id,
                 "chatWaId": chatId,
                 "sender": senderId,
                 "content": content.strip() or None,
                 "timestamp": ts,
-                "status": "sent",
+                "status": status,
                 "file": file_url,
                 "fileName": file_name,
-                "referenceContent": referenceContent
+                "referenceContent": referenceContent,
+                "media": media,
+                "thumbnail": thumbnail
             }
 
-            db.messages.insert_one(message_doc)
-
-            db.chats.update_one(
-                {"waId": chatId},
-                {
-                    "$set": {
-                        "lastMessage": content or file_name,
-                        "timestamp": ts,
+            await db.messages.insert_one(message_doc)
+
+            async with chat_version() as version:
+                await db.chats.update_one(
+                    {"waId": chatId},
+                    {
+                        "$set": {
+                            "lastMessage": content or file_name,
+                            "timestamp": ts,
+                            "version": version
+                        },
+                        "$inc": {"unreadCount": 1}
                     },
-                    "$inc": {"unreadCount": 1}
-                },
-                upsert=True
-            )
+                    upsert=True
+                )
             
-            # Send the message to the WhatsApp API
+            # Queue the message for the WhatsApp API; the outbox dispatcher sends it.
+            # Media still to be transcoded takes its place in line now, so a text
+            # sent right after it can't overtake it.
             try:
-                if file_url:
-                    # Determine media type from file extension
-                    if file_url.endswith(('.jpg', '.jpeg', '.png')):
-                        media_type = "image"
-                    elif file_url.endswith('.mp4'):
-                        media_type = "video"
-                    elif file_url.endswith('.ogg'):
-                        media_type = "audio"
-                    else:
-                        media_type = "document"
-
-                    send_whatsapp_message(
+                if media_job:
+                    await enqueue_whatsapp_message(to=chatId, message_id=id, waiting=True)
+                elif file_url:
+                    await enqueue_whatsapp_message(
                         to=chatId,
-                        media_type=media_type,
+                        message_id=id,
+                        media_type=media_type_for(file_url),
                         media_url=local_file_path,
-                        media_filename=file_name
+                        media_filename=file_name,
+                        media_hash=file_hash
                     )
                 elif content:
-                    send_whatsapp_message(
+                    await enqueue_whatsapp_message(
                         to=chatId,
+                        message_id=id,
                         text=content
                     )
             except Exception as e:
-                print(f"❌ Failed to send message to WhatsApp API: {e}")
+                print(f"❌ Failed to queue message for WhatsApp API: {e}")
+
+            if media_job:
+                await enqueue_media_job(
+                    message_id=id,
+                    chat_id=chatId,
+                    file_name=file_name,
+                    **media_job
+                )
 
 
             return {
@@ -219,8 +196,8 @@ def register_post_endpoints(app: FastAPI):
                 "chatId": chatId,
                 "senderId": senderId,
                 "content": content,
-                "timestamp": ts.timestamp() * 1000,
-                "status": "sent",
+                "timestamp": ts.replace(tzinfo=timezone.utc).timestamp() * 1000,
+                "status": status,
                 "file": file_url,
                 "fileName": file_name,
                 "referenceContent": referenceContent
@@ -239,7 +216,7 @@ def register_post_endpoints(app: FastAPI):
             if not message_id or not requester_id:
                 raise HTTPException(status_code=400, detail="Missing messageId or requesterId")
 
-            message = db.messages.find_one({"_id": message_id})
+            message = await db.messages.find_one({"_id": message_id})
 
             if not message:
                 raise HTTPException(status_code=404, detail="Message not found")
@@ -248,7 +225,7 @@ def register_post_endpoints(app: FastAPI):
                 raise HTTPException(status_code=403, detail="You can only delete your own messages")
 
             # ✨ En vez de eliminarlo, lo actualizamos
-            db.messages.update_one(
+            await db.messages.update_one(
                 {"_id": message_id},
                 {"$set": {
                     "content": "Este mensaje se ha borrado",
@@ -277,18 +254,18 @@ def register_post_endpoints(app: FastAPI):
 
         try:
             # Verificamos que el mensaje exista
-            message = db.messages.find_one({"_id": message_id})
+            message = await db.messages.find_one({"_id": message_id})
             if not message:
                 raise HTTPException(status_code=404, detail="Message not found")
 
             # Eliminamos reacción previa del mismo usuario, si existe
-            db.messages.update_one(
+            await db.messages.update_one(
                 {"_id": message_id},
                 {"$pull": {"reactions": {"user": requester_id}}}
             )
 
             # Añadimos la nueva reacción
-            db.messages.update_one(
+            await db.messages.update_one(
                 {"_id": message_id},
                 {"$push": {"reactions": {"user": requester_id, "emoji": emoji}}}
             )
@@ -306,7 +283,7 @@ def register_post_endpoints(app: FastAPI):
             if not waId:
                 raise HTTPException(status_code=400, detail="Missing waId")
 
-            chat_doc = db.chats.find_one({"waId": waId})
+            chat_doc = await db.chats.find_one({"waId": waId})
             if not chat_doc:
                 raise HTTPException(status_code=404, detail="Chat not found")
 
@@ -314,12 +291,14 @@ def register_post_endpoints(app: FastAPI):
             is_pinned = chat_doc.get("isPinned", False)
 
             # Invertir pin
-            result = db.chats.update_one(
-                {"waId": waId},
-                {"$set": {
-                    "isPinned": not is_pinned,
-                }}
-            )
+            async with chat_version() as version:
+                result = await db.chats.update_one(
+                    {"waId": waId},
+                    {"$set": {
+                        "isPinned": not is_pinned,
+                        "version": version
+                    }}
+                )
             return {"success": True, "isPinned": not is_pinned}
 
         except HTTPException:
@@ -335,7 +314,7 @@ def register_post_endpoints(app: FastAPI):
             if not waId:
                 raise HTTPException(status_code=400, detail="Missing waId")
 
-            chat_doc = db.chats.find_one({"waId": waId})
+            chat_doc = await db.chats.find_one({"waId": waId})
             if not chat_doc:
                 raise HTTPException(status_code=404, detail="Chat not found")
 
@@ -343,12 +322,14 @@ def register_post_endpoints(app: FastAPI):
             is_muted = chat_doc.get("isMuted", False)
 
             # Invertir mute, mantener el valor de pin
-            result = db.chats.update_one(
-                {"waId": waId},
-                {"$set": {
-                    "isMuted": not is_muted,
-                }}
-            )
+            async with chat_version() as version:
+                result = await db.chats.update_one(
+                    {"waId": waId},
+                    {"$set": {
+                        "isMuted": not is_muted,
+                        "version": version
+                    }}
+                )
             return {"success": True, "isMuted": not is_muted}
 
         except HTTPException:
@@ -364,7 +345,7 @@ def register_post_endpoints(app: FastAPI):
             if not waId:
                 raise HTTPException(status_code=400, detail="Missing waId")
 
-            chat_doc = db.chats.find_one({"waId": waId})
+            chat_doc = await db.chats.find_one({"waId": waId})
             if not chat_doc:
                 raise HTTPException(status_code=404, detail="Chat not found")
 
@@ -373,12 +354,14 @@ def register_post_endpoints(app: FastAPI):
 
             print("isBlocked: ", is_blocked, " not blocked: ", not is_blocked)
             # Invertir block, mantener el valor de pin
-            result = db.chats.update_one(
-                {"waId": waId},
-                {"$set": {
-                    "isBlocked": not is_blocked,
-                }}
-            )
+            async with chat_version() as version:
+                result = await db.chats.update_one(
+                    {"waId": waId},
+                    {"$set": {
+                        "isBlocked": not is_blocked,
+                        "version": version
+                    }}
+                )
             return {"success": True, "isBlocked": not is_blocked}
 
         except HTTPException:
@@ -393,14 +376,14 @@ def register_post_endpoints(app: FastAPI):
         waId: str,
         groupWaId: str = Query(...)
     ):
-        chat_doc = db.chats.find_one({"waId": groupWaId})
+        chat_doc = await db.chats.find_one({"waId": groupWaId})
         if not chat_doc:
             raise HTTPException(status_code=404, detail="Group chat not found")
         if not chat_doc.get("isGroup", False):
             raise HTTPException(status_code=400, detail="This is not a group chat")
 
         # Buscar contacto en contacts
-        contact = db.contacts.find_one({"waId": waId})
+        contact = await db.contacts.find_one({"waId": waId})
         if not contact:
             # Opcional: devolver error si no se encuentra el contacto
             raise HTTPException(status_code=404, detail="Contact not found")
@@ -416,10 +399,11 @@ def register_post_endpoints(app: FastAPI):
             if p.get("waId") == waId:
                 return {"success": False, "message": "Participant already in group"}
 
-        updated = db.chats.update_one(
-            {"waId": groupWaId},
-            {"$push": {"participants": participant_data}}
-        )
+        async with chat_version() as version:
+            updated = await db.chats.update_one(
+                {"waId": groupWaId},
+                {"$push": {"participants": participant_data}, "$set": {"version": version}}
+            )
 
         if updated.modified_count == 0:
             return {"success": False, "message": "Failed to add participant"}
@@ -433,19 +417,20 @@ def register_post_endpoints(app: FastAPI):
         groupWaId: str = Query(..., description="ID del grupo")
     ):
         # Aquí ya tienes ambos valores disponibles
-        chat_doc = db.chats.find_one({"waId": groupWaId})
+        chat_doc = await db.chats.find_one({"waId": groupWaId})
         if not chat_doc:
             raise HTTPException(status_code=404, detail="Group chat not found")
         if not chat_doc.get("isGroup", False):
             raise HTTPException(status_code=400, detail="This is not a group chat")
 
-        updated = db.chats.update_one(
+        updated = await db.chats.update_one(
             {"waId": groupWaId},
             {"$pull": {"participants": {"waId": waId}}}
         )
 
         if updated.modified_count == 0:
             return {"success": False, "message": "Participant not found in group"}
+        await bump_chat_version(groupWaId)
 
         return {"success": True, "message": "Participant removed"}
 
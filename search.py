@@ -0,0 +1,104 @@
+# search.py
+#
+# Full-text search over messages.content and messages.fileName, backed by
+# the messages "content_text" index (see indexes.py). Results are ranked
+# by textScore, then newest first, and paged with a keyset cursor on
+# (score, timestamp, _id). Snippets are cut around the first matching
+# term so the UI can show why a message matched.
+
+import re
+import unicodedata
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SNIPPET_RADIUS = 60
+
+SEARCH_PROJECTION = {
+    "chatWaId": 1,
+    "sender": 1,
+    "content": 1,
+    "timestamp": 1,
+    "status": 1,
+    "file": 1,
+    "fileName": 1,
+    "thumbnail": 1,
+    "score": 1
+}
+
+
+def build_search_pipeline(q, chat_id=None, cursor=None, limit=SEARCH_PAGE_SIZE):
+    match = {"$text": {"$search": q}}
+    if chat_id:
+        match["chatWaId"] = chat_id
+
+    pipeline = [
+        {"$match": match},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+    ]
+    if cursor:
+        score, timestamp, message_id = cursor["s"], cursor["t"], cursor["id"]
+        pipeline.append({"$match": {"$or": [
+            {"score": {"$lt": score}},
+            {"score": score, "timestamp": {"$lt": timestamp}},
+            {"score": score, "timestamp": timestamp, "_id": {"$lt": message_id}}
+        ]}})
+    pipeline += [
+        {"$sort": {"score": -1, "timestamp": -1, "_id": -1}},
+        {"$limit": limit + 1},
+        {"$project": SEARCH_PROJECTION}
+    ]
+    return pipeline
+
+
+async def search_messages(collection, q, chat_id=None, cursor=None, limit=SEARCH_PAGE_SIZE):
+    # Returns (page, next_key); next_key is None on the last page
+    pipeline = build_search_pipeline(q, chat_id, cursor, limit)
+    page = await collection.aggregate(pipeline).to_list(length=limit + 1)
+
+    next_key = None
+    if len(page) > limit:
+        page = page[:limit]
+        last = page[-1]
+        next_key = {"s": last["score"], "t": last.get("timestamp"), "id": last["_id"]}
+    return page, next_key
+
+
+def fold(text):
+    # Lowercase and strip accents one character at a time, so offsets still line up
+    return "".join(unicodedata.normalize("NFD", ch)[0].lower() for ch in text)
+
+
+def search_terms(q):
+    # Positive words and phrases only; "-word" excludes and shouldn't be highlighted
+    phrases = re.findall(r'"([^"]+)"', q)
+    words = [w for w in re.findall(r'(?<![\w-])-?\w+', re.sub(r'"[^"]*"', " ", q)) if not w.startswith("-")]
+    return [fold(t) for t in phrases + words if t.strip()]
+
+
+def make_snippet(text, terms, radius=SNIPPET_RADIUS):
+    # Returns (snippet, highlights) with highlights as [start, end) offsets into snippet
+    if not text:
+        return None, []
+    folded = fold(text)
+    hits = [(m.start(), m.end()) for term in terms for m in re.finditer(re.escape(term), folded)]
+    if not hits:
+        return (text[:radius * 2] + ("…" if len(text) > radius * 2 else "")), []
+
+    first = min(start for start, _ in hits)
+    start = max(0, first - radius)
+    end = min(len(text), first + radius)
+    # Don't cut words in half at the edges
+    if start > 0:
+        space = text.find(" ", start)
+        start = space + 1 if 0 <= space < first else start
+    if end < len(text):
+        space = text.rfind(" ", first, end)
+        end = space if space > first else end
+
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(text) else ""
+    offset = len(prefix) - start
+    highlights = sorted(
+        [s + offset, e + offset] for s, e in hits if s >= start and e <= end
+    )
+    return prefix + text[start:end] + suffix, highlights
@@ -1,9 +1,154 @@
 # sse.py
+#
+# In-process broker for /sse. Every browser tab gets a bounded queue and,
+# optionally, a set of chats it cares about. Payloads are serialized once
+# per publish and the same string is shared by all subscribers. Events go
+# out through the backplane so every worker delivers them.
+#
+# Every event carries a monotonically increasing id. The last
+# SSE_REPLAY_SIZE events are kept so a client reconnecting with
+# Last-Event-ID gets what it missed, or a "resync" event when the gap
+# is no longer in the buffer.
+
 import asyncio
+import json
+import os
+from collections import deque
+
+from backplane import create_backplane
+
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "100"))
+# "drop_oldest": discard the oldest queued event; "disconnect": close the slow client
+SSE_OVERFLOW_POLICY = os.getenv("SSE_OVERFLOW_POLICY", "drop_oldest")
+SSE_REPLAY_SIZE = int(os.getenv("SSE_REPLAY_SIZE", "1000"))
+
+
+def format_event(event_id, data, event=None):
+    frame = f"id: {event_id}\n"
+    if event:
+        frame += f"event: {event}\n"
+    return frame + f"data: {data}\n\n"
+
+
+class Subscriber:
+    def __init__(self, chats=None, maxsize=SSE_QUEUE_SIZE, policy=SSE_OVERFLOW_POLICY):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.chats = set(chats) if chats else None
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+
+    def wants(self, chat_id):
+        return self.chats is None or chat_id is None or chat_id in self.chats
+
+    def offer(self, data):
+        if self.closed:
+            return False
+
+        if self.queue.full():
+            if self.policy == "disconnect":
+                self.close()
+                return False
+            self.queue.get_nowait()
+            self.dropped += 1
+
+        self.queue.put_nowait(data)
+        return True
+
+    def close(self):
+        # Empty the queue and leave a None sentinel so the stream loop exits
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class Broker:
+    def __init__(self, backplane):
+        self.backplane = backplane
+        self.backplane.attach(self.deliver)
+        self.subscribers = set()
+        # (event_id, chat_id, frame), oldest first
+        self.replay = deque(maxlen=SSE_REPLAY_SIZE)
+        self.last_event_id = 0
+        self.published = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self.replayed = 0
+        self.resyncs = 0
+
+    def subscribe(self, chats=None, last_event_id=None):
+        subscriber = Subscriber(chats)
+        if last_event_id is not None:
+            self.catch_up(subscriber, last_event_id)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def catch_up(self, subscriber, last_event_id):
+        if last_event_id == self.last_event_id:
+            return
+
+        # The buffer covers the gap only if it starts right after what the client saw
+        covered = (
+            last_event_id < self.last_event_id
+            and self.replay
+            and self.replay[0][0] <= last_event_id + 1
+        )
+        missed = [frame for event_id, chat_id, frame in self.replay if event_id > last_event_id and subscriber.wants(chat_id)] if covered else []
+
+        if not covered or len(missed) >= subscriber.queue.maxsize:
+            self.resyncs += 1
+            subscriber.offer(format_event(self.last_event_id, json.dumps({"type": "resync_required"}), event="resync"))
+            return
+
+        for frame in missed:
+            subscriber.offer(frame)
+        self.replayed += len(missed)
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+            self.dropped += subscriber.dropped
+
+    def publish(self, payload, chat_id=None):
+        data = payload if isinstance(payload, str) else json.dumps(payload, default=str)
+        self.published += 1
+        self.backplane.publish(data, chat_id)
+
+    def deliver(self, data, chat_id, event_id):
+        frame = format_event(event_id, data)
+        self.replay.append((event_id, chat_id, frame))
+        self.last_event_id = event_id
+
+        for subscriber in list(self.subscribers):
+            if not subscriber.wants(chat_id):
+                continue
+            if not subscriber.offer(frame):
+                print("⚠️ Disconnecting slow SSE client")
+                self.disconnected += 1
+                self.unsubscribe(subscriber)
+
+    def metrics(self):
+        depths = [s.queue.qsize() for s in self.subscribers]
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "dropped": self.dropped + sum(s.dropped for s in self.subscribers),
+            "disconnected": self.disconnected,
+            "lastEventId": self.last_event_id,
+            "replayBuffered": len(self.replay),
+            "replayed": self.replayed,
+            "resyncs": self.resyncs,
+            "queueDepthMax": max(depths, default=0),
+            "queueDepthTotal": sum(depths),
+            "queueSize": SSE_QUEUE_SIZE,
+            "overflowPolicy": SSE_OVERFLOW_POLICY,
+            "backplane": type(self.backplane).__name__
+        }
+
+
+broker = Broker(create_backplane())
 
-connected_clients = []
 
-async def push_to_clients(message: str):
-    print("pushing to client")
-    for queue in connected_clients:
-        await queue.put(message)
\ No newline at end of file
+async def push_to_clients(message, chat_id=None):
+    broker.publish(message, chat_id=chat_id)
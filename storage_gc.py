@@ -0,0 +1,338 @@
+# storage_gc.py
+#
+# Background collector for uploads/temporalFiles. Every TEMP_GC_INTERVAL
+# seconds it reference-counts files against messages.file and:
+#   - deletes orphans (no message points at them) once past a grace period
+#   - deletes stale intermediates (_probe, _converting, .part, .download,
+#     abandoned uploads in pending/)
+#   - promotes files still referenced after TEMP_PROMOTE_AFTER_DAYS to
+#     permanentFiles and rewrites the message URLs (the old URLs keep
+#     working through the /uploads fallback in file_server)
+#   - evicts least recently used files while over TEMP_QUOTA_BYTES and
+#     marks their messages "evicted" over SSE
+# Files a queued media job or outbox send still needs are never touched.
+# Only the worker holding the "storage_gc" lease in db.locks collects.
+#
+#   python storage_gc.py --dry-run   # report what would happen
+#   python storage_gc.py             # collect once
+
+import argparse
+import asyncio
+import os
+import re
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+from db import db
+from file_server import file_index, variant_path, ENCODINGS
+from functions import PUBLIC_BASE_URL
+from sse import broker
+from thumbnails import cache as thumbnail_cache, THUMB_WIDTHS
+
+BASE_TEMP_DIR = os.path.join("uploads", "temporalFiles")
+PERMANENT_DIR = os.path.join("uploads", "permanentFiles")
+CATEGORIES = ["images", "videos", "documents"]
+
+TEMP_GC_INTERVAL = float(os.getenv("TEMP_GC_INTERVAL", "3600"))
+# 0 disables eviction
+TEMP_QUOTA_BYTES = int(os.getenv("TEMP_QUOTA_BYTES", str(20 * 1024 ** 3)))
+TEMP_PROMOTE_AFTER_DAYS = float(os.getenv("TEMP_PROMOTE_AFTER_DAYS", "30"))
+# An upload is on disk a moment before its message is; don't race it
+ORPHAN_GRACE_SECONDS = 24 * 3600
+INTERMEDIATE_MAX_AGE_SECONDS = 3600
+
+INTERMEDIATE_NAME = re.compile(r"(_probe|_converting)|\.(part|download)$")
+TEMP_URL = re.compile(r"/temporalFiles/([^/]+)/([^/?#]+)")
+GC_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+gc_task = None
+last_report = None
+
+
+def temp_key(file_url):
+    # (category, name) for URLs pointing into temporalFiles, whatever the host
+    match = TEMP_URL.search(file_url or "")
+    return (match.group(1), match.group(2)) if match else None
+
+
+def scan_temp_files():
+    files = []
+    # Older uploads left their _probe files in the temporalFiles root itself
+    if os.path.isdir(BASE_TEMP_DIR):
+        for entry in os.scandir(BASE_TEMP_DIR):
+            if entry.is_file() and INTERMEDIATE_NAME.search(entry.name):
+                stat = entry.stat()
+                files.append({
+                    "category": "root",
+                    "name": entry.name,
+                    "path": entry.path,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime
+                })
+    for category in CATEGORIES + ["pending"]:
+        directory = os.path.join(BASE_TEMP_DIR, category)
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append({
+                    "category": category,
+                    "name": entry.name,
+                    "path": entry.path,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime
+                })
+    return files
+
+
+async def collect_references():
+    # (category, name) -> {"refs", "urls", "lastUsed"}
+    refs = {}
+    pipeline = [
+        {"$match": {"file": {"$type": "string"}}},
+        {"$group": {"_id": "$file", "refs": {"$sum": 1}, "lastUsed": {"$max": "$timestamp"}}}
+    ]
+    async for row in db.messages.aggregate(pipeline, allowDiskUse=True):
+        key = temp_key(row["_id"])
+        if not key:
+            continue
+        ref = refs.setdefault(key, {"refs": 0, "urls": [], "lastUsed": 0.0})
+        ref["refs"] += row["refs"]
+        ref["urls"].append(row["_id"])
+        last_used = row.get("lastUsed")
+        if hasattr(last_used, "timestamp"):
+            ref["lastUsed"] = max(ref["lastUsed"], last_used.replace(tzinfo=timezone.utc).timestamp())
+
+    # Re-uploads of the same bytes count as a use too
+    async for entry in db.media_cache.find({"lastHitAt": {"$exists": True}}, {"category": 1, "uniqueName": 1, "lastHitAt": 1}):
+        ref = refs.get((entry["category"], entry["uniqueName"]))
+        if ref:
+            ref["lastUsed"] = max(ref["lastUsed"], entry["lastHitAt"].replace(tzinfo=timezone.utc).timestamp())
+
+    protected = set()
+    async for job in db.media_jobs.find({"status": {"$in": ["queued", "running"]}}, {"inputPath": 1}):
+        protected.add(os.path.basename(job.get("inputPath") or ""))
+    async for item in db.outbox.find({"status": {"$in": ["pending", "sending"]}}, {"payload.media_url": 1}):
+        protected.add(os.path.basename(item.get("payload", {}).get("media_url") or ""))
+    protected.discard("")
+
+    return refs, protected
+
+
+async def acquire_gc_lease():
+    # Every worker runs the loop; the lease makes sure only one of them collects.
+    # The holder renews it each pass, anyone may take it once it runs out.
+    now = datetime.utcnow()
+    try:
+        await db.locks.update_one(
+            {"_id": "storage_gc", "$or": [{"owner": GC_OWNER}, {"leaseUntil": {"$lt": now}}]},
+            {"$set": {"owner": GC_OWNER, "leaseUntil": now + timedelta(seconds=TEMP_GC_INTERVAL)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def extend_gc_lease():
+    # Count the interval from the end of a long pass, not its start
+    await db.locks.update_one(
+        {"_id": "storage_gc", "owner": GC_OWNER},
+        {"$set": {"leaseUntil": datetime.utcnow() + timedelta(seconds=TEMP_GC_INTERVAL)}}
+    )
+
+
+def remove_file(path, file_hashes=()):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    file_index.remove(path)
+    for _, suffix in ENCODINGS:
+        try:
+            os.remove(variant_path(path, suffix))
+        except FileNotFoundError:
+            pass
+    # Thumbnails are named after the content hash, not the file
+    for file_hash in file_hashes:
+        for width in THUMB_WIDTHS:
+            thumbnail_cache.remove(f"{file_hash}_{width}.jpg")
+
+
+def plan_gc(files, refs, protected, now):
+    actions = []
+    kept = []
+
+    for f in files:
+        age = now - f["mtime"]
+        if f["name"] in protected:
+            kept.append(f)
+            continue
+
+        if f["category"] == "pending" or INTERMEDIATE_NAME.search(f["name"]):
+            if age > INTERMEDIATE_MAX_AGE_SECONDS:
+                actions.append({**f, "action": "delete", "reason": "intermediate"})
+            else:
+                kept.append(f)
+            continue
+
+        ref = refs.get((f["category"], f["name"]))
+        if not ref:
+            if age > ORPHAN_GRACE_SECONDS:
+                actions.append({**f, "action": "delete", "reason": "orphan"})
+            else:
+                kept.append(f)
+            continue
+
+        if age > TEMP_PROMOTE_AFTER_DAYS * 86400:
+            actions.append({**f, "action": "promote", "reason": "long-lived", "refs": ref["refs"], "urls": ref["urls"]})
+            continue
+
+        kept.append({**f, "lastUsed": max(ref["lastUsed"], f["mtime"]), "refs": ref["refs"], "urls": ref["urls"]})
+
+    total = sum(f["size"] for f in kept)
+    if TEMP_QUOTA_BYTES and total > TEMP_QUOTA_BYTES:
+        # Only referenced, settled files are evictable; in-flight work is not
+        for f in sorted((f for f in kept if "lastUsed" in f), key=lambda f: f["lastUsed"]):
+            if total <= TEMP_QUOTA_BYTES:
+                break
+            actions.append({**f, "action": "evict", "reason": "quota"})
+            total -= f["size"]
+
+    return actions, total
+
+
+async def apply_action(action):
+    path = action["path"]
+
+    if action["action"] == "promote":
+        os.makedirs(PERMANENT_DIR, exist_ok=True)
+        permanent_path = os.path.join(PERMANENT_DIR, action["name"])
+        if os.path.exists(permanent_path):
+            remove_file(path)
+        else:
+            os.replace(path, permanent_path)
+            file_index.remove(path)
+        file_index.add(permanent_path)
+        await db.messages.update_many(
+            {"file": {"$in": action["urls"]}},
+            {"$set": {"file": f"{PUBLIC_BASE_URL}/uploads/permanentFiles/{action['name']}"}}
+        )
+        # Keep dedup and thumbnails working for the moved file
+        await db.media_cache.update_many(
+            {"category": action["category"], "uniqueName": action["name"]},
+            {"$set": {"permanent": True}}
+        )
+        return
+
+    cached = {"category": action["category"], "uniqueName": action["name"]}
+    file_hashes = []
+    if action["category"] in CATEGORIES:
+        file_hashes = [entry["_id"] async for entry in db.media_cache.find(cached, {"_id": 1})]
+
+    remove_file(path, file_hashes)
+    if action["action"] == "evict":
+        await evict_messages(action["urls"])
+    if file_hashes:
+        await db.media_cache.delete_many(cached)
+
+
+async def evict_messages(urls):
+    # Drop the dead links so clients show "no longer available" instead of a 404
+    messages = await db.messages.find(
+        {"file": {"$in": urls}}, {"chatWaId": 1, "fileName": 1}
+    ).to_list(length=None)
+    await db.messages.update_many(
+        {"_id": {"$in": [msg["_id"] for msg in messages]}},
+        {"$set": {"file": None, "thumbnail": None, "fileStatus": "evicted"}}
+    )
+    for msg in messages:
+        broker.publish({
+            "type": "message_update",
+            "id": msg["_id"],
+            "chatId": msg["chatWaId"],
+            "file": None,
+            "fileName": msg.get("fileName"),
+            "thumbnail": None,
+            "fileStatus": "evicted"
+        }, chat_id=msg["chatWaId"])
+
+
+async def run_gc(dry_run=False):
+    global last_report
+    started = time.time()
+    files = await asyncio.to_thread(scan_temp_files)
+    refs, protected = await collect_references()
+    actions, remaining = plan_gc(files, refs, protected, started)
+
+    applied = []
+    for action in actions:
+        if not dry_run:
+            try:
+                await apply_action(action)
+            except Exception as e:
+                print(f"❌ GC could not {action['action']} {action['path']}: {e}")
+                continue
+        applied.append({k: action[k] for k in ("action", "reason", "category", "name", "size")})
+
+    summary = {}
+    for action in applied:
+        bucket = summary.setdefault(f"{action['action']}:{action['reason']}", {"files": 0, "bytes": 0})
+        bucket["files"] += 1
+        bucket["bytes"] += action["size"]
+
+    report = {
+        "dryRun": dry_run,
+        "scannedFiles": len(files),
+        "scannedBytes": sum(f["size"] for f in files),
+        "remainingBytes": remaining,
+        "quotaBytes": TEMP_QUOTA_BYTES,
+        "summary": summary,
+        "actions": applied,
+        "seconds": round(time.time() - started, 3)
+    }
+    if not dry_run:
+        last_report = report
+    print(f"🧹 Storage GC{' (dry run)' if dry_run else ''}: {summary or 'nothing to do'}")
+    return report
+
+
+async def run_collector():
+    while True:
+        try:
+            if await acquire_gc_lease():
+                await run_gc()
+                await extend_gc_lease()
+        except Exception as e:
+            print(f"❌ Storage GC error: {e}")
+        await asyncio.sleep(TEMP_GC_INTERVAL)
+
+
+async def start_storage_gc():
+    global gc_task
+    gc_task = asyncio.create_task(run_collector())
+
+
+async def stop_storage_gc():
+    if gc_task:
+        gc_task.cancel()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true", help="report what would be done without touching anything")
+    args = parser.parse_args()
+
+    report = await run_gc(dry_run=args.dry_run)
+    for action in report["actions"]:
+        print(f"{action['action']:>8} {action['reason']:<12} {action['size']:>12} {action['category']}/{action['name']}")
+    print(f"scanned {report['scannedFiles']} files / {report['scannedBytes']} bytes, "
+          f"{report['remainingBytes']} bytes left (quota {report['quotaBytes']})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
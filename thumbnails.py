@@ -0,0 +1,185 @@
+# thumbnails.py
+#
+# On-demand derivatives for chat media: image thumbnails and video poster
+# frames, rendered on first request and kept in uploads/derivatives as
+# {hash}_{width}.jpg. The directory is an LRU capped at
+# THUMB_CACHE_MAX_BYTES.
+
+import asyncio
+import os
+import subprocess
+from collections import OrderedDict
+
+from PIL import Image
+
+from db import db
+from functions import PUBLIC_BASE_URL
+from media_cache import artifact_path
+
+THUMB_DIR = os.path.join("uploads", "derivatives")
+THUMB_WIDTHS = [160, 320, 640]
+DEFAULT_THUMB_WIDTH = 320
+THUMB_CACHE_MAX_BYTES = int(os.getenv("THUMB_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+
+class DerivativeCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # name -> size, least recently used first
+        self.total = 0
+        self.loaded = False
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".jpg"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total += size
+        self.loaded = True
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        if not self.loaded:
+            self.load()
+        if name not in self.entries:
+            return None
+        try:
+            # mtime doubles as last-use time so the order survives restarts
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            # Removed by another worker or the storage collector
+            self.total -= self.entries.pop(name)
+            return None
+        self.entries.move_to_end(name)
+        return self.path(name)
+
+    def put(self, name):
+        size = os.path.getsize(self.path(name))
+        self.total += size - self.entries.pop(name, 0)
+        self.entries[name] = size
+
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            evicted, evicted_size = self.entries.popitem(last=False)
+            self.total -= evicted_size
+            try:
+                os.remove(self.path(evicted))
+            except FileNotFoundError:
+                pass
+
+    def remove(self, name):
+        self.total -= self.entries.pop(name, 0)
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        return {"files": len(self.entries), "bytes": self.total, "maxBytes": self.max_bytes}
+
+
+cache = DerivativeCache(THUMB_DIR, THUMB_CACHE_MAX_BYTES)
+render_locks = {}  # name -> [lock, callers holding or waiting on it]
+
+
+def snap_width(width):
+    # Only a few widths, so clients can't fill the cache with one-off sizes
+    return next((w for w in THUMB_WIDTHS if w >= width), THUMB_WIDTHS[-1])
+
+
+def image_dimensions(path):
+    try:
+        with Image.open(path) as img:
+            return {"width": img.width, "height": img.height}
+    except Exception as e:
+        print(f"⚠️ Could not read image size: {e}")
+        return {}
+
+
+def thumbnail_info(file_hash, media, width=DEFAULT_THUMB_WIDTH):
+    # URL and layout size of the thumbnail, computed from the source dimensions
+    if not media or not media.get("width") or not media.get("height"):
+        return None
+    source_width, source_height = media["width"], media["height"]
+    if source_width > width:
+        source_height = round(source_height * width / source_width)
+        source_width = width
+    return {
+        "url": f"{PUBLIC_BASE_URL}/media/{file_hash}/thumb?w={width}",
+        "width": source_width,
+        "height": source_height
+    }
+
+
+def render_image_thumbnail(source_path, output_path, width):
+    with Image.open(source_path) as img:
+        # draft() lets the JPEG decoder skip straight to a reduced scale
+        img.draft("RGB", (width, width))
+        img.thumbnail((width, width * 4))
+        img.convert("RGB").save(output_path, format="JPEG", quality=80)
+
+
+def render_video_poster(source_path, output_path, width):
+    # Try one second in first, then the very first frame for short clips
+    for offset in ("1", "0"):
+        result = subprocess.run([
+            "ffmpeg", "-y",
+            "-ss", offset,
+            "-i", source_path,
+            "-frames:v", "1",
+            "-vf", f"scale='min({width},iw)':-2",
+            "-f", "image2",
+            output_path
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if result.returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            return
+    raise RuntimeError("ffmpeg could not extract a poster frame")
+
+
+async def get_thumbnail(file_hash, width):
+    name = f"{file_hash}_{width}.jpg"
+    path = cache.get(name)
+    if path:
+        return path
+
+    # Any 64-hex hash reaches this, so the lock goes away with its last user
+    # whatever the outcome, not only after a render
+    lock_entry = render_locks.setdefault(name, [asyncio.Lock(), 0])
+    lock_entry[1] += 1
+    try:
+        async with lock_entry[0]:
+            path = cache.get(name)
+            if path:
+                return path
+
+            entry = await db.media_cache.find_one({"_id": file_hash})
+            if not entry or entry["category"] not in ("images", "videos"):
+                return None
+
+            source_path = artifact_path(entry)
+            if not os.path.exists(source_path):
+                return None
+
+            renderer = render_image_thumbnail if entry["category"] == "images" else render_video_poster
+            partial_path = cache.path(f"{name}.part")
+            try:
+                await asyncio.to_thread(renderer, source_path, partial_path, width)
+                os.replace(partial_path, cache.path(name))
+            except Exception as e:
+                print(f"❌ Thumbnail failed for {file_hash}: {e}")
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                return None
+
+            cache.put(name)
+            return cache.path(name)
+    finally:
+        lock_entry[1] -= 1
+        if lock_entry[1] == 0:
+            render_locks.pop(name, None)
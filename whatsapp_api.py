@@ -1,113 +1,412 @@
-from fastapi import FastAPI, Request
-from functions import send_whatsapp_message, ensure_chat_exists, save_message_to_db
-from sse import push_to_clients
-
+from fastapi import FastAPI, HTTPException, Request
+from functions import new_chat_defaults, chat_version, public_file_url, probe_media
+from thumbnails import image_dimensions, thumbnail_info
+from media_cache import lookup_media, remember_media, artifact_url
+from outbox import enqueue_whatsapp_message
+from sse import broker
+from db import db
+
+from graph_api import graph
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from datetime import datetime, timedelta
+
+import asyncio
+import hashlib
 import mimetypes
 import json
-import requests
 import os
+import uuid
 
-WHATSAPP_API_URL = "https://graph.facebook.com/v19.0"
 ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 
 
 
+SUPPORTED_MEDIA_TYPES = ["image", "audio", "video", "document"]
+
+MEDIA_DOWNLOAD_CONCURRENCY = int(os.getenv("MEDIA_DOWNLOAD_CONCURRENCY", "4"))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# A "downloading" message whose lease ran out belongs to a worker that died
+DOWNLOAD_LEASE = timedelta(minutes=10)
+# Webhook bodies are stored in db.webhook_inbox before we answer Meta, which
+# never redelivers an acknowledged webhook; failed ones are retried from there
+WEBHOOK_LEASE = timedelta(minutes=5)
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "10"))
+WEBHOOK_RETRY_SECONDS = float(os.getenv("WEBHOOK_RETRY_SECONDS", "60"))
+
+# Keeps references to in-flight webhook tasks so they aren't garbage collected
+webhook_tasks = set()
+webhook_retrier = None
+download_semaphore = asyncio.Semaphore(MEDIA_DOWNLOAD_CONCURRENCY)
+
+
 def register_whatsapp_endpoints(app: FastAPI):
     @app.post("/webhook")
     async def receive_webhook(request: Request):
         try:
             body = await request.json()
-            print("🔔 Received webhook payload:", body)
+        except Exception as e:
+            print(f"❌ Error parsing webhook data: {e}")
+            return {"status": "received"}
+
+        print("🔔 Received webhook payload:", body)
+
+        # Persist before acknowledging: once we answer 200 this is our only copy.
+        # If the write fails, a 500 makes Meta deliver it again.
+        now = datetime.utcnow()
+        item = {
+            "_id": uuid.uuid4().hex,
+            "body": body,
+            "status": "processing",
+            "attempts": 0,
+            "leaseUntil": now + WEBHOOK_LEASE,
+            "receivedAt": now
+        }
+        try:
+            await db.webhook_inbox.insert_one(item)
+        except Exception as e:
+            print(f"❌ Could not store webhook: {e}")
+            raise HTTPException(status_code=500, detail="Webhook not stored")
 
-            entry = body["entry"][0]
-            changes = entry["changes"][0]
-            value = changes["value"]
-            messages = value.get("messages", [])
+        # Acknowledge right away; Meta retries anything that is slow to answer
+        start_background(handle_webhook(item))
+        return {"status": "received"}
 
-            if not messages:
-                return {"status": "no_message"}
 
-            message = messages[0]
-            from_number = message["from"]
-            message_type = message["type"]
+def iter_webhook_values(body):
+    for entry in body.get("entry", []):
+        for change in entry.get("changes", []):
+            yield change.get("value", {})
 
-            ensure_chat_exists(from_number)
 
-            file_path = None
-            file_name = None
-            content = None
+def build_inbound_message(message):
+    # Turns one Cloud API message into our messages document (None if unsupported).
+    # Media is not downloaded here; the document carries what fetch_inbound_media needs.
+    message_type = message.get("type")
+    file_name = None
+    pending_media = None
 
-            if message_type == "text":
-                content = message["text"]["body"]
+    if message_type == "text":
+        content = message["text"]["body"]
 
-            elif message_type in ["image", "audio", "video", "document"]:
-                media = message[message_type]
-                print(f"📦 Media message received: {media}")
+    elif message_type in SUPPORTED_MEDIA_TYPES:
+        media = message[message_type]
+        print(f"📦 Media message received: {media}")
 
-                media_id = media["id"]
-                mime_type = media.get("mime_type", "application/octet-stream")
-                file_name = media.get("filename", f"{media_id}.{mime_type.split('/')[-1]}")
+        media_id = media["id"]
+        mime_type = media.get("mime_type", "application/octet-stream")
+        file_name = media.get("filename", f"{media_id}.{mime_type.split('/')[-1]}")
 
-                file_path = download_media(media_id, mime_type, file_name)
-                content = f"[{message_type} received]"
+        pending_media = {"mediaId": media_id, "mimeType": mime_type}
+        content = f"[{message_type} received]"
 
-            else:
-                print(f"⚠️ Unsupported message type: {message_type}")
-                return {"status": "unsupported_type"}
+    else:
+        print(f"⚠️ Unsupported message type: {message_type}")
+        return None
 
-            # Save to DB
-            save_message_to_db(
-                to=from_number,
-                sender="them",
-                content=content,
-                file=file_path,
-                file_name=file_name,
-                reference_id=message.get("id"),
-                waba_id=value["metadata"]["phone_number_id"]
-            )
+    try:
+        timestamp = datetime.utcfromtimestamp(int(message["timestamp"]))
+    except (KeyError, TypeError, ValueError):
+        timestamp = datetime.utcnow()
+
+    # The WhatsApp message id is the _id, so Meta's retries collide on the unique index
+    doc = {
+        "_id": message["id"],
+        "chatWaId": message["from"],
+        "sender": "them",
+        "content": content,
+        "timestamp": timestamp,
+        "status": "sent",
+        "file": None,
+        "fileName": file_name,
+        "referenceContent": message.get("context", {}).get("id"),
+        "wabaMessageId": message["id"]
+    }
+    if pending_media:
+        doc["fileStatus"] = "downloading"
+        doc["pendingMedia"] = pending_media
+        # This worker downloads it; resume_inbound_media only takes expired leases
+        doc["downloadLeaseUntil"] = datetime.utcnow() + DOWNLOAD_LEASE
+    return doc
+
+
+async def process_webhook(body):
+    # Returns the errors hit; both parts are idempotent, so a retry is safe
+    values = list(iter_webhook_values(body))
+    errors = []
+    try:
+        await ingest_messages(values)
+    except Exception as e:
+        print(f"❌ Error processing webhook messages: {e}")
+        errors.append(f"messages: {e}")
+    try:
+        await ingest_statuses(values)
+    except Exception as e:
+        print(f"❌ Error processing webhook statuses: {e}")
+        errors.append(f"statuses: {e}")
+    return errors
+
+
+async def handle_webhook(item):
+    try:
+        errors = await process_webhook(item["body"])
+    except Exception as e:
+        errors = [str(e)]
+
+    mine = {"_id": item["_id"], "status": "processing"}
+    if not errors:
+        await db.webhook_inbox.update_one(
+            mine, {"$set": {"status": "done", "processedAt": datetime.utcnow()}, "$unset": {"leaseUntil": ""}}
+        )
+        return
+
+    attempts = item["attempts"] + 1
+    now = datetime.utcnow()
+    if attempts >= WEBHOOK_MAX_ATTEMPTS:
+        print(f"❌ Giving up on webhook {item['_id']} after {attempts} attempts")
+        update = {"status": "failed", "failedAt": now}
+    else:
+        # Stays claimed until the retry time, then the retrier picks it up
+        update = {"status": "pending", "leaseUntil": now + timedelta(seconds=min(3600, 30 * 2 ** attempts))}
+    await db.webhook_inbox.update_one(
+        mine, {"$set": {**update, "attempts": attempts, "lastError": "; ".join(errors)}}
+    )
 
-            send_whatsapp_message(from_number, "✅ Message received!", auto_save=True)
 
+async def retry_webhooks():
+    # Failed or interrupted (worker died mid-way) webhooks whose lease ran out
+    retried = 0
+    while True:
+        now = datetime.utcnow()
+        item = await db.webhook_inbox.find_one_and_update(
+            {"status": {"$in": ["pending", "processing"]}, "leaseUntil": {"$lt": now}},
+            {"$set": {"status": "processing", "leaseUntil": now + WEBHOOK_LEASE}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not item:
+            break
+        start_background(handle_webhook(item))
+        retried += 1
+    if retried:
+        print(f"🔁 Retrying {retried} stored webhooks")
+
+
+async def run_webhook_retrier():
+    while True:
+        try:
+            await retry_webhooks()
         except Exception as e:
-            print(f"❌ Error parsing webhook data: {e}")
+            print(f"❌ Webhook retrier error: {e}")
+        await asyncio.sleep(WEBHOOK_RETRY_SECONDS)
 
-        return {"status": "received"}
+
+async def start_webhook_retrier():
+    global webhook_retrier
+    webhook_retrier = asyncio.create_task(run_webhook_retrier())
 
 
+async def stop_webhook_retrier():
+    if webhook_retrier:
+        webhook_retrier.cancel()
 
 
-def download_media(media_id, mime_type=None, file_name=None):
-    # 1. Get media URL
-    media_url_response = requests.get(
-        f"{WHATSAPP_API_URL}/{media_id}",
-        headers={"Authorization": f"Bearer {ACCESS_TOKEN}"}
+def build_inbound_messages(raw_messages):
+    # One malformed message must not sink the rest of the batch
+    docs = []
+    for message in raw_messages:
+        try:
+            doc = build_inbound_message(message)
+        except Exception as e:
+            print(f"⚠️ Skipping malformed webhook message {message.get('id')}: {e!r}")
+            continue
+        if doc:
+            docs.append(doc)
+    return docs
+
+
+async def ingest_messages(values):
+    raw_messages = [m for value in values for m in value.get("messages", []) if m.get("id")]
+    if not raw_messages:
+        return
+
+    # Skip ids we already stored before doing any work on them
+    ids = [m["id"] for m in raw_messages]
+    known = {doc["_id"] async for doc in db.messages.find({"_id": {"$in": ids}}, {"_id": 1})}
+    fresh = list({m["id"]: m for m in raw_messages if m["id"] not in known}.values())
+
+    docs = build_inbound_messages(fresh)
+    if not docs:
+        return
+
+    # New chats get their version from the last-message update below
+    senders = sorted({doc["chatWaId"] for doc in docs})
+    await db.chats.bulk_write([
+        UpdateOne({"waId": wa_id}, {"$setOnInsert": new_chat_defaults()}, upsert=True)
+        for wa_id in senders
+    ], ordered=False)
+
+    write_error = None
+    try:
+        await db.messages.insert_many(docs, ordered=False)
+        inserted = docs
+    except BulkWriteError as e:
+        # Duplicates from a concurrent retry are expected; anything else fails the
+        # webhook (after the rest is handled) so the retry stores what is missing
+        errors = e.details.get("writeErrors", [])
+        if any(err.get("code") != 11000 for err in errors):
+            write_error = e
+        failed_indexes = {err["index"] for err in errors}
+        inserted = [doc for i, doc in enumerate(docs) if i not in failed_indexes]
+
+    # One chat update per sender: latest message wins, unread counts add up
+    latest = {}
+    counts = {}
+    for doc in inserted:
+        wa_id = doc["chatWaId"]
+        counts[wa_id] = counts.get(wa_id, 0) + 1
+        if wa_id not in latest or doc["timestamp"] >= latest[wa_id]["timestamp"]:
+            latest[wa_id] = doc
+    if latest:
+        async with chat_version(len(latest)) as last_version:
+            first_version = last_version - len(latest) + 1
+            await db.chats.bulk_write([
+                UpdateOne(
+                    {"waId": wa_id},
+                    {
+                        "$set": {"lastMessage": doc["content"], "timestamp": doc["timestamp"], "version": first_version + i},
+                        "$inc": {"unreadCount": counts[wa_id]}
+                    }
+                )
+                for i, (wa_id, doc) in enumerate(latest.items())
+            ], ordered=False)
+
+    for doc in inserted:
+        broker.publish(doc, chat_id=doc["chatWaId"])
+        await enqueue_whatsapp_message(doc["chatWaId"], text="✅ Message received!", auto_save=True)
+
+        if doc.get("pendingMedia"):
+            media = doc["pendingMedia"]
+            start_background(fetch_inbound_media(doc["_id"], doc["chatWaId"], media["mediaId"], media["mimeType"], doc["fileName"]))
+
+    print(f"📥 Webhook stored {len(inserted)} of {len(raw_messages)} messages")
+    if write_error:
+        raise write_error
+
+
+
+
+# Delivery states only move forward; failed can only follow sent
+STATUS_RANK = {"processing": 0, "sent": 1, "failed": 2, "delivered": 3, "read": 4}
+
+
+async def ingest_statuses(values):
+    # Keep the most advanced status reported for each WhatsApp message id
+    incoming = {}
+    for value in values:
+        for status in value.get("statuses", []):
+            wamid, state = status.get("id"), status.get("status")
+            if state not in STATUS_RANK:
+                continue
+            if wamid not in incoming or STATUS_RANK[state] > STATUS_RANK[incoming[wamid]["status"]]:
+                incoming[wamid] = status
+    if not incoming:
+        return
+
+    known = db.messages.find(
+        {"wabaMessageId": {"$in": list(incoming)}},
+        {"_id": 1, "chatWaId": 1, "status": 1, "wabaMessageId": 1}
     )
 
-    if media_url_response.status_code != 200:
-        print(f"❌ Failed to fetch media URL: {media_url_response.text}")
-        return None
+    operations = []
+    deltas = []
+    async for msg in known:
+        status = incoming[msg["wabaMessageId"]]
+        state = status["status"]
+        if STATUS_RANK.get(msg.get("status"), -1) >= STATUS_RANK[state]:
+            continue
 
-    media_url = media_url_response.json()["url"]
+        lower_states = [s for s, rank in STATUS_RANK.items() if rank < STATUS_RANK[state]]
+        update = {"status": state}
+        try:
+            update["statusUpdatedAt"] = datetime.utcfromtimestamp(int(status["timestamp"]))
+        except (KeyError, TypeError, ValueError):
+            update["statusUpdatedAt"] = datetime.utcnow()
+        if state == "failed" and status.get("errors"):
+            update["statusErrors"] = status["errors"]
 
-    # 2. Download file
-    media_file_response = requests.get(
-        media_url,
-        headers={"Authorization": f"Bearer {ACCESS_TOKEN}"}
-    )
+        # The status filter guards against a concurrent webhook that already moved it further
+        operations.append(UpdateOne(
+            {"_id": msg["_id"], "status": {"$in": lower_states + [None]}},
+            {"$set": update}
+        ))
+        deltas.append({"type": "status", "id": msg["_id"], "chatId": msg["chatWaId"], "status": state})
 
-    if media_file_response.status_code != 200:
-        print(f"❌ Failed to download media: {media_file_response.text}")
-        return None
+    if not operations:
+        return
+
+    await db.messages.bulk_write(operations, ordered=False)
+
+    for delta in deltas:
+        broker.publish(delta, chat_id=delta["chatId"])
+
+    print(f"📬 Applied {len(operations)} status updates")
+
+
+async def download_media(media_id, mime_type=None):
+    # Streams the media to disk while hashing it, then stores it content-addressed.
+    # Returns (file_url, file_hash) or (None, None).
+    async with download_semaphore:
+        # 1. Get media URL
+        media_url_response = await graph.get(
+            f"/{media_id}",
+            headers={"Authorization": f"Bearer {ACCESS_TOKEN}"}
+        )
+
+        if media_url_response.status_code != 200:
+            print(f"❌ Failed to fetch media URL: {media_url_response.text}")
+            return None, None, None
+
+        media_url = media_url_response.json()["url"]
 
-    # 3. Guess MIME type and extension
-    if not mime_type:
-        mime_type = media_file_response.headers.get("Content-Type", "application/octet-stream")
+        # 2. Stream file to a temp name, hashing as chunks arrive
+        pending_dir = os.path.join("uploads", "temporalFiles", "pending")
+        os.makedirs(pending_dir, exist_ok=True)
+        temp_path = os.path.join(pending_dir, f"{media_id}.download")
+        sha256 = hashlib.sha256()
+
+        try:
+            async with graph.stream("GET", media_url, headers={"Authorization": f"Bearer {ACCESS_TOKEN}"}) as media_file_response:
+                if media_file_response.status_code != 200:
+                    print(f"❌ Failed to download media: {media_file_response.status_code}")
+                    return None, None, None
+
+                # 3. Guess MIME type if not provided
+                if not mime_type:
+                    mime_type = media_file_response.headers.get("Content-Type", "application/octet-stream")
+
+                with open(temp_path, "wb") as f:
+                    async for chunk in media_file_response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        sha256.update(chunk)
+                        f.write(chunk)
+        except Exception as e:
+            print(f"❌ Failed to download media: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None, None, None
+
+    file_hash = sha256.hexdigest()
+
+    # 4. Reuse a file we already hold with the same bytes
+    cached = await lookup_media(file_hash)
+    if cached:
+        os.remove(temp_path)
+        return artifact_url(cached), file_hash, cached.get("media")
 
     extension = mimetypes.guess_extension(mime_type.split(";")[0]) or ".bin"
-    if extension.startswith("."):
-        extension = extension[1:]
+    if not extension.startswith("."):
+        extension = f".{extension}"
 
-    # 4. Prepare save directory
+    # 5. Prepare save directory
     media_type_to_folder = {
         "image": "images",
         "video": "videos",
@@ -122,15 +421,84 @@ def download_media(media_id, mime_type=None, file_name=None):
     save_dir = os.path.join("uploads", "temporalFiles", save_subdir)
     os.makedirs(save_dir, exist_ok=True)
 
-    # 5. Filename handling
-    base_name = file_name or f"{media_id}"
-    base_name = os.path.splitext(base_name)[0]  # Remove any existing extension
-    full_path = os.path.join(save_dir, f"{base_name}.{extension}")
-
-    print(f"💾 Saving media to: {full_path} (type: {mime_type})")
-
-    # 6. Save to disk
-    with open(full_path, "wb") as f:
-        f.write(media_file_response.content)
-
-    return f"https://bricopoxi.com/{full_path}"
+    # 6. Content-addressed name: identical bytes never overwrite anything else
+    unique_name = f"{file_hash}{extension}"
+    full_path = os.path.join(save_dir, unique_name)
+    if os.path.exists(full_path):
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, full_path)
+
+    print(f"💾 Saved media to: {full_path} (type: {mime_type})")
+    media = await asyncio.to_thread(inbound_media_info, full_path, save_subdir)
+    await remember_media(file_hash, save_subdir, unique_name, media)
+
+    return public_file_url(save_subdir, unique_name), file_hash, media
+
+
+def inbound_media_info(path, category):
+    # Same shape outbound messages get, so the UI can lay out a thumbnail
+    if category == "images":
+        return image_dimensions(path)
+    if category == "videos":
+        probe = probe_media(path)
+        return {key: probe[key] for key in ("duration", "width", "height", "videoCodec", "audioCodec")}
+    return None
+
+
+async def fetch_inbound_media(message_id, chat_id, media_id, mime_type, file_name):
+    # Fills in the message's file once the download finishes and tells the browsers
+    try:
+        file_url, file_hash, media = await download_media(media_id, mime_type)
+    except Exception as e:
+        # Fire-and-forget task: an escaping error would leave the message "downloading" forever
+        print(f"❌ Inbound media {media_id} for {message_id} failed: {e}")
+        file_url, file_hash, media = None, None, None
+    file_status = "ready" if file_url else "failed"
+    thumbnail = thumbnail_info(file_hash, media) if file_url else None
+
+    await db.messages.update_one(
+        {"_id": message_id},
+        {
+            "$set": {"file": file_url, "fileStatus": file_status, "media": media, "thumbnail": thumbnail},
+            "$unset": {"pendingMedia": "", "downloadLeaseUntil": ""}
+        }
+    )
+    broker.publish({
+        "type": "message_update",
+        "id": message_id,
+        "chatId": chat_id,
+        "file": file_url,
+        "fileName": file_name,
+        "fileStatus": file_status,
+        "media": media,
+        "thumbnail": thumbnail
+    }, chat_id=chat_id)
+
+
+async def resume_inbound_media():
+    # Downloads cut short by a restart; claim each one so only one worker resumes it
+    resumed = 0
+    while True:
+        now = datetime.utcnow()
+        doc = await db.messages.find_one_and_update(
+            {
+                "fileStatus": "downloading",
+                "pendingMedia": {"$exists": True},
+                "$or": [{"downloadLeaseUntil": {"$exists": False}}, {"downloadLeaseUntil": {"$lt": now}}]
+            },
+            {"$set": {"downloadLeaseUntil": now + DOWNLOAD_LEASE}}
+        )
+        if not doc:
+            break
+        media = doc["pendingMedia"]
+        start_background(fetch_inbound_media(doc["_id"], doc["chatWaId"], media["mediaId"], media["mimeType"], doc.get("fileName")))
+        resumed += 1
+    if resumed:
+        print(f"🔁 Resuming {resumed} inbound media downloads")
+
+
+def start_background(coro):
+    task = asyncio.create_task(coro)
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)